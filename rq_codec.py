@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+'''
+JSON codec layer for our record hot paths.
+
+loads() and dumps() use orjson or msgspec when either is installed, falling back
+to the stdlib json module; call use_codec() to pick one explicitly. dumps() always
+returns a str, and renders datetimes as ISO-8601 and UUIDs as strings regardless
+of which codec is in use.
+
+decode_manifest_record() decodes a download/ingest manifest line into a compact
+ManifestRecord (a msgspec Struct when msgspec is available), ignoring any fields
+outside the manifest schema.
+'''
+
+import json
+import uuid
+import datetime
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+MANIFEST_FIELDS = ['base_url', 'srcfile', 'local_file', 'header_file', 'metahash']
+
+
+def default_encoder(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+
+    return str(obj)
+
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=default_encoder)
+
+
+def _orjson_loads(data):
+    return orjson.loads(data)
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=default_encoder).decode('utf-8')
+
+
+def _msgspec_loads(data):
+    return msgspec.json.decode(data)
+
+
+def _msgspec_dumps(obj):
+    return msgspec.json.encode(obj, enc_hook=default_encoder).decode('utf-8')
+
+
+CODECS = {
+    'json': (_stdlib_loads, _stdlib_dumps),
+    'orjson': (_orjson_loads, _orjson_dumps),
+    'msgspec': (_msgspec_loads, _msgspec_dumps),
+}
+
+codec_name = None
+_loads = None
+_dumps = None
+
+
+def available_codecs():
+    return [name for name, module in [('orjson', orjson), ('msgspec', msgspec), ('json', json)] if module]
+
+
+def use_codec(name):
+    global codec_name, _loads, _dumps
+
+    if name not in available_codecs():
+        raise Exception(f'JSON codec "{name}" is not available. Available codecs: {", ".join(available_codecs())}')
+
+    codec_name = name
+    _loads, _dumps = CODECS[name]
+
+
+def loads(data):
+    return _loads(data)
+
+
+def dumps(obj):
+    return _dumps(obj)
+
+
+use_codec(available_codecs()[0])
+
+
+if msgspec:
+
+    class ManifestRecord(msgspec.Struct):
+        base_url: str
+        srcfile: str
+        local_file: str
+        header_file: Optional[str] = None
+        metahash: Optional[str] = None
+
+        def to_dict(self):
+            return msgspec.structs.asdict(self)
+
+    _manifest_decoder = msgspec.json.Decoder(ManifestRecord)
+
+    def decode_manifest_record(data) -> ManifestRecord:
+        return _manifest_decoder.decode(data)
+
+else:
+
+    class ManifestRecord(object):
+        __slots__ = MANIFEST_FIELDS
+
+        def __init__(self, base_url, srcfile, local_file, header_file=None, metahash=None):
+            self.base_url = base_url
+            self.srcfile = srcfile
+            self.local_file = local_file
+            self.header_file = header_file
+            self.metahash = metahash
+
+        def to_dict(self):
+            return {field: getattr(self, field) for field in MANIFEST_FIELDS}
+
+    def decode_manifest_record(data) -> ManifestRecord:
+        record = loads(data)
+        return ManifestRecord(**{field: record[field] for field in MANIFEST_FIELDS if field in record})
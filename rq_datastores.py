@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 
-import os
-import json
+import os, sys
 import uuid
+import time
+import atexit
 import datetime 
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from snap import common
 from mercury.dataload import DataStore
 from mercury.mlog import mlog, mlog_err
 from sqlalchemy import select, update, bindparam, text
 from sqlalchemy.schema import Table
+import rq_utils as utils
+import rq_codec as codec
 
 
 
@@ -19,6 +25,29 @@ class ObjectFactory(object):
         return DbObject(**kwargs)
 
 
+def local_file_path(s3_svc, filename):
+    '''Return the path of a manifest's local file, which is downloaded into the
+    S3 service's local temp path.'''
+
+    return os.path.join(os.getcwd(), s3_svc.local_tmp_path, filename)
+
+
+def live_asset_uris(db_service, asset_ids):
+    '''Return a dict mapping those of <asset_ids> which are live (not deleted) assets
+    to their S3 URIs.'''
+
+    if not asset_ids:
+        return {}
+
+    query = text('''
+        SELECT id, s3_uri FROM file_assets
+        WHERE id = ANY(CAST(:ids AS uuid[])) AND deleted_ts IS NULL
+    ''')
+
+    with db_service.engine.connect() as connection:
+        return {str(row.id): row.s3_uri for row in connection.execute(query, {"ids": [str(asset_id) for asset_id in asset_ids]})}
+
+
 class ConsoleDatastore(DataStore):
 
     def __init__(self,service_object_registry, *channels, **kwargs):
@@ -30,55 +59,476 @@ class ConsoleDatastore(DataStore):
             print(raw_rec)
 
 
-class S3Datastore(DataStore):
-    def __init__(self,service_object_registry, *channels, **kwargs):
+class WritePipeline(object):
+    '''Write batches on a pool of worker threads, behind a bounded queue.
+
+    submit() blocks once <queue_size> batches are in flight, so a fast reader cannot
+    outrun the writers. The batch-write function returns the lines to emit on stdout;
+    in ordered mode these are emitted in submission order, otherwise as each batch
+    completes. drain() (also registered to run at exit) waits for every outstanding
+    batch, emits its output and shuts the workers down.
+
+    A batch that fails is logged, and its exception is re-raised by the next call
+    to submit() or drain(); if that happens at exit, the process exits with status 1.
+    '''
+
+    def __init__(self, write_function, workers=2, queue_size=4, ordered=True):
+        self.write_function = write_function
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = deque()
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.output_lock = threading.Lock()
+        self.drained = False
+        self.error = None
+
+        atexit.register(self.drain_at_exit)
+
+
+    def run_batch(self, records, write_params):
+        try:
+            output_lines = self.write_function(records, **write_params)
+            if not self.ordered:
+                self.emit(output_lines)
+            return output_lines
+
+        except Exception as err:
+            mlog_err(err, issue="Error writing batch.", records=len(records))
+            with self.output_lock:
+                if self.error is None:
+                    self.error = err
+            return []
+
+        finally:
+            if not self.ordered:
+                self.slots.release()
+
+
+    def emit(self, output_lines):
+        with self.output_lock:
+            for line in output_lines:
+                print(line)
+
+
+    def emit_completed(self, block=False):
+        '''In ordered mode, emit the output of finished batches at the head of the queue
+        (waiting for the head batch if <block> is set).'''
+
+        while self.in_flight and (block or self.in_flight[0].done()):
+            self.emit(self.in_flight.popleft().result())
+
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+    def submit(self, records, **write_params):
+        self.check_error()
+
+        if self.ordered:
+            while len(self.in_flight) >= self.queue_size:
+                self.emit(self.in_flight.popleft().result())
+        else:
+            self.slots.acquire()
+
+        future = self.executor.submit(self.run_batch, list(records), write_params)
+
+        if self.ordered:
+            self.in_flight.append(future)
+            self.emit_completed()
+
+
+    def drain(self):
+        if not self.drained:
+            if self.ordered:
+                self.emit_completed(block=True)
+
+            self.executor.shutdown(wait=True)
+            self.drained = True
+
+        self.check_error()
+
+
+    def drain_at_exit(self):
+        # an exception raised from an atexit handler does not change the exit status
+        try:
+            self.drain()
+        except Exception:
+            sys.stdout.flush()
+            os._exit(1)
+
+
+class PipelinedDataStore(DataStore):
+    '''Base class for datastores which can write their batches on a pool of worker
+    threads, so that ngst keeps reading input while earlier batches are written.
+
+    Pipelining is enabled by the "pipeline_workers" init param; "pipeline_queue_size"
+    (default: twice the worker count) bounds the number of batches in flight, and
+    "pipeline_ordered" (default true) keeps output in input order.
+
+    Subclasses implement write_batch(), which returns the lines to emit on stdout.
+    '''
+
+    def __init__(self, service_object_registry, *channels, **kwargs):
         super().__init__(service_object_registry, *channels, **kwargs)
 
+        self.pipeline = None
+        pipeline_workers = int(kwargs.get('pipeline_workers') or 0)
+
+        if pipeline_workers:
+            self.pipeline = WritePipeline(
+                self.write_batch,
+                workers=pipeline_workers,
+                queue_size=int(kwargs.get('pipeline_queue_size') or 2 * pipeline_workers),
+                ordered=utils.to_boolean(kwargs.get('pipeline_ordered', True))
+            )
+
+
+    def write_batch(self, records, **write_params):
+        raise NotImplementedError()
+
 
     def write(self, records, **write_params):
+        if self.pipeline:
+            self.pipeline.submit(records, **write_params)
+            return
 
-        s3_svc = self.service_object_registry.lookup('s3')
-        infra_svc = self.service_object_registry.lookup('infra')
+        for line in self.write_batch(records, **write_params):
+            print(line)
 
-        bucket_name = infra_svc.lookup_infra_asset('s3_bucket_id')
 
+class S3Datastore(PipelinedDataStore):
+    def __init__(self,service_object_registry, *channels, **kwargs):
+        super().__init__(service_object_registry, *channels, **kwargs)
+
+        # number of files uploaded concurrently; 1 uploads serially
+        self.upload_workers = int(kwargs.get('upload_workers', 1))
+        self.upload_policy = utils.RetryPolicy(
+            max_attempts=kwargs.get('upload_attempts', 3),
+            base_delay=kwargs.get('upload_retry_delay', 1.0),
+            exception_policies={FileNotFoundError: None}
+        )
+        self.upload_executor = None
+        if self.upload_workers > 1:
+            self.upload_executor = ThreadPoolExecutor(max_workers=self.upload_workers)
+
+        self.s3_svc = None
+        self.bucket_name = None
+
+        # name of a DeduplicatorService; a file whose content a live asset already holds
+        # is copied, within S3, from that asset's object rather than uploaded
+        self.dedup_service_name = kwargs.get('dedup_service')
+
+        # pipelined batches must not read the index while another batch is purging it
+        # ahead of its uploads; see copy_duplicates()
+        self.dedup_lock = threading.Lock()
+
+
+    def resolve_services(self):
+        if self.s3_svc is None:
+            self.s3_svc = self.service_object_registry.lookup('s3')
+            infra_svc = self.service_object_registry.lookup('infra')
+            self.bucket_name = infra_svc.lookup_infra_asset('s3_bucket_id')
+
+        return self.s3_svc, self.bucket_name
+
+
+    def upload_file(self, filename, s3_svc, bucket_name):
+        '''Upload a single file, retrying per our upload policy.
+        Returns the number of bytes uploaded, or None if the upload failed.
+        '''
+
+        local_path = local_file_path(s3_svc, filename)
+
+        print(f'uploading local file temp_data/{filename} to S3 bucket {bucket_name}...')
+        try:
+            self.upload_policy.call(s3_svc.upload_object, local_path, bucket_name)
+            return os.path.getsize(local_path)
+
+        except Exception as err:
+            mlog_err(err, issue="Error uploading file to S3.", filename=filename, bucket=bucket_name)
+            return None
+
+
+    def copy_file(self, filename, source_uri, s3_svc, bucket_name):
+        '''Copy the object at <source_uri> to the key of <filename>, retrying per our upload policy.
+        Returns True if the key now holds the object, or False if the copy failed.
+        '''
+
+        source_bucket, source_key = source_uri[len('s3://'):].split('/', 1)
+        if (source_bucket, source_key) == (bucket_name, filename):
+            return True
+
+        print(f'copying S3 object {source_uri} to S3 bucket {bucket_name} as {filename}...')
+        try:
+            self.upload_policy.call(s3_svc.copy_object, source_bucket, source_key, bucket_name, filename)
+            return True
+
+        except Exception as err:
+            mlog_err(err, issue="Error copying S3 object.", source=source_uri, filename=filename, bucket=bucket_name)
+            return False
+
+
+    def copy_duplicates(self, filenames, s3_svc, bucket_name):
+        '''Copy, within S3, the objects of those <filenames> whose content a live asset already
+        holds, then drop the deduplication index entries of the files left to upload, since
+        their keys are about to be overwritten. A file whose copy fails is left to upload.
+
+        This must run under the dedup lock, and before the uploads of this batch: an entry
+        read here is then still good when its object is copied.
+
+        Returns (files to upload, files copied).
+        '''
+
+        dedup_svc = self.service_object_registry.lookup(self.dedup_service_name)
+        db_svc = self.service_object_registry.lookup('postgres')
+
+        live_uris = {}
+        def live_assets(asset_ids):
+            live_uris.update(live_asset_uris(db_svc, asset_ids))
+            return live_uris
+
+        local_paths = {filename: local_file_path(s3_svc, filename) for filename in filenames}
+        _, duplicates = dedup_svc.partition_files(list(local_paths.values()), live_assets)
+
+        copy_jobs = [
+            (filename, live_uris[duplicates[local_paths[filename]]]) for filename in filenames if local_paths[filename] in duplicates
+        ]
+        copy_file = lambda job: self.copy_file(job[0], job[1], s3_svc, bucket_name)
+        if self.upload_executor:
+            results = list(self.upload_executor.map(copy_file, copy_jobs))
+        else:
+            results = [copy_file(job) for job in copy_jobs]
+
+        copied_files = {filename for (filename, _), copied in zip(copy_jobs, results) if copied}
+        upload_files = [filename for filename in filenames if filename not in copied_files]
+        dedup_svc.purge_files(upload_files)
+
+        return upload_files, sorted(copied_files)
+
+
+    def delete_files(self, records, **write_params):
+        '''Delete the S3 objects named in a batch of deletion records, returning 
+        the records whose objects were deleted.
+        '''
+
+        s3_svc, bucket_name = self.resolve_services()
+
+        records_by_key = {}
         for raw_rec in records:
-            rec = json.loads(raw_rec)
-            filename = rec['local_file']
+            try:
+                rec = codec.loads(raw_rec)
+                records_by_key.setdefault(rec['deleted_filename'], raw_rec)
+
+            except Exception as err:
+                mlog_err(err, issue="Error parsing deletion record.", record=raw_rec)
+
+        status = s3_svc.delete_objects(bucket_name, list(records_by_key.keys()))
 
-            local_path = os.path.join(os.getcwd(), s3_svc.local_tmp_path, filename)
+        for error in status['errors']:
+            mlog('!!! Error deleting S3 object.', bucket=bucket_name, **error)
 
-            print(f'uploading local file temp_data/{filename} to S3 bucket {bucket_name}...')
-            s3_svc.upload_object(local_path, bucket_name)
+        mlog('+++ S3 deletion batch complete.',
+             bucket=bucket_name,
+             deleted=len(status['deleted']),
+             failed=len(status['errors']))
+
+        return [records_by_key[key] for key in status['deleted']]
+
+
+    def write_batch(self, records, **write_params):
+
+        if write_params.get('record_type') == 'deletion':
+            return self.delete_files(records, **write_params)
+
+        s3_svc, bucket_name = self.resolve_services()
+        start_time = time.time()
+
+        filenames = []
+        unhashed_count = 0
+        for raw_rec in records:
+            record = codec.decode_manifest_record(raw_rec)
+            # no metahash means the file's headers could not be fetched; it will not be ingested
+            if record.metahash is None:
+                unhashed_count += 1
+                continue
+            filenames.append(record.local_file)
+
+        copied_files = []
+        if self.dedup_service_name:
+            with self.dedup_lock:
+                filenames, copied_files = self.copy_duplicates(filenames, s3_svc, bucket_name)
+
+        if self.upload_executor:
+            results = list(self.upload_executor.map(
+                lambda filename: self.upload_file(filename, s3_svc, bucket_name), filenames
+            ))
+        else:
+            results = [self.upload_file(filename, s3_svc, bucket_name) for filename in filenames]
+
+        uploaded_sizes = [size for size in results if size is not None]
+        total_bytes = sum(uploaded_sizes)
+        elapsed = time.time() - start_time
+
+        mlog('+++ S3 upload batch complete.',
+             bucket=bucket_name,
+             objects=len(uploaded_sizes),
+             failed=len(results) - len(uploaded_sizes),
+             copied=len(copied_files),
+             unhashed_skipped=unhashed_count,
+             bytes=total_bytes,
+             seconds=round(elapsed, 3),
+             mb_per_sec=round(total_bytes / elapsed / 1024**2, 2) if elapsed else None)
+
+        # the db target is fed the same manifest, so a file that failed to upload
+        # must fail the run rather than be ingested with no object behind it
+        failed_files = [filename for filename, size in zip(filenames, results) if size is None]
+        if failed_files:
+            raise Exception(f'{len(failed_files)} of {len(filenames)} files failed to upload to S3 bucket {bucket_name}: {", ".join(failed_files)}')
+
+        return []
 
         
-class PostgresDatastore(DataStore):
+class PostgresDatastore(PipelinedDataStore):
     def __init__(self, service_object_registry, *channels, **kwargs):
         super().__init__(service_object_registry, *channels, **kwargs)
 
+        # in batch mode, each checkpoint batch is written in a single transaction
+        # rather than one transaction per record
+        self.batch_mode = utils.to_boolean(kwargs.get('batch_mode', False))
 
-    def write_asset_record(self, record, db_service, **write_params):
-    
-        infra_svc = self.service_object_registry.lookup('infra')
-        bucket_name = infra_svc.lookup_infra_asset('s3_bucket_id')
+        # how batch-mode rows are inserted: 'executemany' (SQLAlchemy's default),
+        # one multi-row 'values' or 'unnest' statement per chunk, or 'copy'
+        self.insert_method = kwargs.get('insert_method', 'executemany')
+        if self.insert_method not in ['executemany', 'copy'] + utils.BULK_INSERT_FORMS:
+            raise Exception(f'Unsupported insert_method "{self.insert_method}" for PostgresDatastore.')
+
+        # name of a DeduplicatorService; in batch mode, the content of each new asset is
+        # registered with it (so that a later S3 upload of the same content can be copied
+        # from the asset's object instead), and deleted assets are purged from it
+        self.dedup_service_name = kwargs.get('dedup_service')
 
-        asset_record = {
+
+    def build_asset_record(self, record, bucket_name, created_ts=None):
+        return {
             'id': str(uuid.uuid4()),
-            's3_uri': f's3://{bucket_name}/{record["local_file"]}',
-            'filename': record['local_file'],
-            'source_url_base': record['base_url'],
-            'source_url_path': record['srcfile'],
-            'source_metahash': record['metahash'],
-            'created_ts': datetime.datetime.now(),
+            's3_uri': f's3://{bucket_name}/{record.local_file}',
+            'filename': record.local_file,
+            'source_url_base': record.base_url,
+            'source_url_path': record.srcfile,
+            'source_metahash': record.metahash,
+            'created_ts': created_ts or datetime.datetime.now(),
             'updated_ts': None,
             'replaces_asset_id': None # TODO: look up record-to-replace by filename
         }
 
+
+    def write_asset_record(self, record, db_service, **write_params):
+
+        if record.metahash is None:
+            raise Exception(f'Asset record for {record.local_file} has no metahash; its headers could not be fetched.')
+
+        infra_svc = self.service_object_registry.lookup('infra')
+        bucket_name = infra_svc.lookup_infra_asset('s3_bucket_id')
+
+        asset_record = self.build_asset_record(record, bucket_name)
+
         with db_service.txn_scope() as session:
             db_asset_record = ObjectFactory.create_db_object('file_assets', db_service, **asset_record)
             session.add(db_asset_record)
         
-        return record['metahash']
+        return record.metahash
+
+
+    def insert_asset_rows(self, staged_rows, db_service):
+        '''Insert a list of (record, asset_row) pairs as a single multi-row INSERT
+        inside one transaction. If the transaction fails, we split the batch in half 
+        and retry each half, so that only the offending rows are rejected.
+
+        Returns the list of source records whose rows were written.
+        '''
+
+        if not staged_rows:
+            return []
+
+        file_assets = db_service.Base.classes.file_assets.__table__
+        asset_rows = [row for _, row in staged_rows]
+
+        try:
+            with db_service.engine.begin() as connection:
+                if self.insert_method == 'copy':
+                    utils.copy_records(connection, file_assets.name, asset_rows)
+
+                elif self.insert_method in utils.BULK_INSERT_FORMS:
+                    column_types = {
+                        column.name: column.type.compile(dialect=db_service.engine.dialect) for column in file_assets.columns
+                    }
+                    utils.bulk_insert(connection, file_assets.name, asset_rows,
+                                      form=self.insert_method,
+                                      column_types=column_types)
+                else:
+                    connection.execute(file_assets.insert(), asset_rows)
+
+            return [record for record, _ in staged_rows]
+
+        except Exception as err:
+            if len(staged_rows) == 1:
+                mlog_err(err, issue="Error ingesting asset record.", record=staged_rows[0][0].to_dict())
+                return []
+
+            midpoint = len(staged_rows) // 2
+            return self.insert_asset_rows(staged_rows[:midpoint], db_service) \
+                + self.insert_asset_rows(staged_rows[midpoint:], db_service)
+
+
+    def write_asset_batch(self, records, db_service, **write_params):
+        
+        start_time = time.time()
+
+        infra_svc = self.service_object_registry.lookup('infra')
+        bucket_name = infra_svc.lookup_infra_asset('s3_bucket_id')
+        batch_ts = datetime.datetime.now()
+
+        asset_records = []
+        for raw_rec in records:
+            try:
+                asset_records.append(codec.decode_manifest_record(raw_rec))
+
+            except Exception as err:
+                mlog_err(err, issue="Error parsing asset record.", record=raw_rec)
+
+        # no metahash means the file's headers could not be fetched; it is not ingested
+        decoded_count = len(asset_records)
+        asset_records = [rec for rec in asset_records if rec.metahash is not None]
+        unhashed_count = decoded_count - len(asset_records)
+
+        staged_rows = [(rec, self.build_asset_record(rec, bucket_name, batch_ts)) for rec in asset_records]
+        written_records = self.insert_asset_rows(staged_rows, db_service)
+
+        # every asset's object is its own (the S3 target uploaded or copied it), so any
+        # written asset can stand for its content; content already indexed keeps its entry
+        if self.dedup_service_name and written_records:
+            dedup_svc = self.service_object_registry.lookup(self.dedup_service_name)
+            s3_svc = self.service_object_registry.lookup('s3')
+            asset_ids = {rec.local_file: row['id'] for rec, row in staged_rows}
+            content_hashes = dedup_svc.hash_files([local_file_path(s3_svc, rec.local_file) for rec in written_records])
+            dedup_svc.register_many([
+                (content_hash, asset_ids[rec.local_file], rec.local_file)
+                for rec, content_hash in zip(written_records, content_hashes) if content_hash is not None
+            ])
+
+        elapsed = time.time() - start_time
+        mlog('+++ asset batch written.',
+             records=len(records),
+             rows_written=len(written_records),
+             rows_rejected=len(records) - len(written_records) - unhashed_count,
+             unhashed_skipped=unhashed_count,
+             seconds=round(elapsed, 3),
+             rows_per_sec=round(len(written_records) / elapsed, 1) if elapsed else None)
+
+        return written_records
     
 
     def delete_asset_record(self, record, db_service, **write_params):
@@ -96,30 +546,86 @@ class PostgresDatastore(DataStore):
             })
 
 
-    def write(self, records, **write_params):
+    def delete_asset_batch(self, records, db_service, **write_params):
+        '''Soft-delete every asset named in a batch of deletion records with a single
+        UPDATE. Only the records whose assets were actually marked deleted are returned
+        (and echoed), so that downstream S3 deletions never outrun the database.
+        '''
+
+        deletion_targets = {}
+        for raw_rec in records:
+            try:
+                rec = codec.loads(raw_rec)
+                deletion_targets.setdefault(rec['deleted_filename'], raw_rec)
+
+            except Exception as err:
+                mlog_err(err, issue="Error parsing deletion record.", record=raw_rec)
+
+        if not deletion_targets:
+            return []
+
+        mlog(f'deleting asset records for {len(deletion_targets)} filenames...')
+
+        deletion_stmt = text('''
+            UPDATE file_assets SET deleted_ts = :deletion_time
+            WHERE filename = ANY(:files) AND deleted_ts IS NULL
+            RETURNING id, filename
+        ''')
+
+        try:
+            with db_service.engine.begin() as connection:
+                result = connection.execute(deletion_stmt, {
+                    "files": list(deletion_targets.keys()),
+                    "deletion_time": datetime.datetime.now()
+                })
+                deleted_assets = {str(row.id): row.filename for row in result}
+
+        except Exception as err:
+            mlog_err(err, issue="Error deleting asset records.", filenames=list(deletion_targets.keys()))
+            return []
+
+        if self.dedup_service_name and deleted_assets:
+            dedup_svc = self.service_object_registry.lookup(self.dedup_service_name)
+            dedup_svc.purge_assets(deleted_assets.keys())
+
+        deleted_filenames = set(deleted_assets.values())
+        return [raw_rec for filename, raw_rec in deletion_targets.items() if filename in deleted_filenames]
+
+
+    def write_batch(self, records, **write_params):
         postgres_svc = self.service_object_registry.lookup("postgres")
         record_type = write_params.get("record_type", "asset")
 
-        for raw_rec in records:
-            rec = json.loads(raw_rec)
+        if self.batch_mode:
+            if record_type == 'asset':
+                return [rec.metahash for rec in self.write_asset_batch(records, postgres_svc)]
 
+            elif record_type == 'deletion':
+                return self.delete_asset_batch(records, postgres_svc)
+            return []
+
+        output_lines = []
+        for raw_rec in records:
             if record_type == 'asset':
                 try:
-                    output_str = self.write_asset_record(rec, postgres_svc)
-                    print(output_str)
+                    rec = codec.decode_manifest_record(raw_rec)
+                    output_lines.append(self.write_asset_record(rec, postgres_svc))
 
                 except Exception as err:
                     mlog_err(
-                        err, issue=f"Error ingesting {record_type} record.", record=rec
+                        err, issue=f"Error ingesting {record_type} record.", record=raw_rec
                     )
 
             elif record_type == 'deletion':
                 try:
+                    rec = codec.loads(raw_rec)
                     self.delete_asset_record(rec, postgres_svc)
-                    print(raw_rec)
+                    output_lines.append(raw_rec)
 
                 except Exception as err:    
-                    mlog_err(err, issue=f"Error deleting asset record.", record=rec)
+                    mlog_err(err, issue=f"Error deleting asset record.", record=raw_rec)
+
+        return output_lines
             
 
 class FilteringConsoleDatastore(DataStore):
@@ -134,7 +640,9 @@ class FilteringConsoleDatastore(DataStore):
         We have a pair of service objects, each of which loads our campaign IDs into an
         in-memory hash set. Depending on where the incoming record came from
         (Partnerize or Impact) we'll use one or the other service to find out if the current
-        record's campaign ID is on the list."""
+        record's campaign ID is on the list. Either service can be given a Bloom filter
+        (see PGObjectLookupSvc), so that most rejected IDs never reach the exact lookup;
+        the service's cumulative lookup stats are logged after each batch."""
 
         impact_lookup_svc = self.service_object_registry.lookup(
             "impact_cmpgn_id_lookup"
@@ -144,21 +652,33 @@ class FilteringConsoleDatastore(DataStore):
         )
 
         record_source = write_params.get("record_src")
+        passed_count = 0
 
         for raw_rec in records:
-            rec = json.loads(raw_rec)
+            rec = codec.loads(raw_rec)
 
             if record_source == "impact":
                 campaign_id = rec["CampaignId"]
                 if impact_lookup_svc.find(campaign_id):
                     print(raw_rec)
+                    passed_count += 1
 
             elif record_source == "partnerize":
                 feed_id = rec["feed_id"]
                 if partnerize_lookup_svc.find(feed_id):
                     print(raw_rec)
+                    passed_count += 1
 
             else:
                 raise Exception(
                     f"Unrecognized record_src parameter {record_source}. Please check your ngst command line."
                 )
+
+        lookup_svc = impact_lookup_svc if record_source == "impact" else partnerize_lookup_svc
+        mlog(
+            "+++ filtered record batch.",
+            record_src=record_source,
+            records=len(records),
+            passed=passed_count,
+            **lookup_svc.lookup_stats(),
+        )
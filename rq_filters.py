@@ -1,38 +1,110 @@
 #!/usr/bin/env python
 
-from sqlalchemy import select, bindparam, and_
-from sqlalchemy.schema import Table
+from sqlalchemy import text
 
 
-def filter_manifest_records(json_rec, raw_line, service_registry, **kwargs):
+LIVE_ASSETS_QUERY = text('''
+    SELECT filename, source_metahash FROM file_assets WHERE deleted_ts IS NULL
+''')
 
-    db_svc = service_registry.lookup('postgres')
+LIVE_ASSETS_BY_FILENAME_QUERY = text('''
+    SELECT filename, source_metahash FROM file_assets
+    WHERE deleted_ts IS NULL AND filename = ANY(:names)
+''')
 
-    with db_svc.connect() as connection:
+DEFAULT_FILTER_CHUNK_SIZE = 1000
+INDEX_FETCH_SIZE = 10000
+
+
+class FileAssetIndex(object):
+    '''In-memory index of live (non-deleted) file assets, mapping each filename
+    to the metahashes recorded for it. Built with a single query, so that manifest
+    records can be checked without a database round-trip per record.
+    '''
+
+    def __init__(self):
+        self.hashes_by_filename = {}
+
+    def add(self, filename, metahash):
+        self.hashes_by_filename.setdefault(filename, []).append(metahash)
+
+    def load(self, connection, filenames=None):
+        # stream rows through a server-side cursor rather than buffering the whole resultset
+        connection = connection.execution_options(stream_results=True, yield_per=INDEX_FETCH_SIZE)
 
-        FileAsset = Table("file_assets", db_svc.metadata, autoload_with=db_svc.engine)
-        
-        stmt = select(FileAsset).where(
-            and_(FileAsset.c.filename == bindparam('filename'), FileAsset.c.deleted_ts == None)
-        )
-        result = connection.execute(stmt, [{"filename": json_rec['local_file']}])
+        if filenames is None:
+            result = connection.execute(LIVE_ASSETS_QUERY)
+        else:
+            result = connection.execute(LIVE_ASSETS_BY_FILENAME_QUERY, {'names': list(filenames)})
 
-        matching_records = 0
         for record in result:
-            if record.source_metahash == json_rec['metahash']:
-                matching_records += 1
+            self.add(record.filename, record.source_metahash)
 
+        return self
+
+    @classmethod
+    def from_db(cls, db_svc, filenames=None):
+        with db_svc.connect() as connection:
+            return cls().load(connection, filenames)
+
+    def hashes_for(self, filename):
+        return self.hashes_by_filename.get(filename, [])
+
+    def match_count(self, filename, metahash):
+        return self.hashes_for(filename).count(metahash)
+
+    def needs_download(self, json_rec):
+        # no metahash means we could not fetch the file's headers; skip it this time
+        if json_rec.get('metahash') is None:
+            return False
+
+        matching_records = self.match_count(json_rec['local_file'], json_rec['metahash'])
 
         if matching_records > 1:
             raise Exception('+++++++ FATAL DATABASE INCONSISTENCY: duplicate hashes found')
 
         # matching record found, do not re-download
-        if matching_records == 1:              
+        if matching_records == 1:
             return False
-        
+
         # no matching record, good to go
         return True
 
 
+# one index per database service, loaded on first use and reused for every record
+_asset_indexes = {}
+
+
+def filter_manifest_records(json_rec, raw_line, service_registry, **kwargs):
+
+    db_svc = service_registry.lookup('postgres')
+
+    asset_index = _asset_indexes.get(db_svc)
+    if asset_index is None:
+        asset_index = FileAssetIndex.from_db(db_svc)
+        _asset_indexes[db_svc] = asset_index
+
+    return asset_index.needs_download(json_rec)
+
+
+def filter_manifest_batch(json_recs, service_registry, **kwargs):
+    '''Batch variant of filter_manifest_records: returns the records which need
+    downloading, querying only the filenames present in the batch, in chunks of
+    <chunk_size> names per query.
+    '''
+
+    db_svc = service_registry.lookup('postgres')
+    chunk_size = int(kwargs.get('chunk_size', DEFAULT_FILTER_CHUNK_SIZE))
+
+    accepted_records = []
+
+    with db_svc.connect() as connection:
+        for offset in range(0, len(json_recs), chunk_size):
+            chunk = json_recs[offset:offset + chunk_size]
+            asset_index = FileAssetIndex().load(connection, {rec['local_file'] for rec in chunk})
+
+            for rec in chunk:
+                if asset_index.needs_download(rec):
+                    accepted_records.append(rec)
 
-    
\ No newline at end of file
+    return accepted_records
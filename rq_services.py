@@ -2,22 +2,36 @@
 
 import os, sys
 import json
+import hashlib
+import pickle
+import sqlite3
+import mmap
+import struct
 from json.decoder import JSONDecodeError
 from snap import snap, common
 
 from collections import namedtuple
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import time
+import threading
+import bisect
+import functools
+from array import array
+import numpy as np
 import boto3
+from boto3.s3.transfer import TransferConfig
 import sqlalchemy as sqla
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy.dialects.postgresql import BIT
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy import create_engine
 from sqlalchemy import MetaData
+from sqlalchemy import event
 from sqlalchemy_utils import UUIDType
 
 
@@ -26,6 +40,7 @@ import uuid
 
 import psycopg2
 import rq_utils as utils
+import rq_codec as codec
 
 
 S3_AUTH_ERROR_MESSAGE = """
@@ -44,57 +59,674 @@ PSYCOPG_SVC_PARAM_NAMES = [
 
 POSTGRESQL_SVC_PARAM_NAMES = ["host", "port", "dbname", "username", "password"]
 
+S3_DELETE_BATCH_SIZE = 1000  # the most keys a single DeleteObjects call accepts
+
+DEFAULT_EXPORT_FETCH_SIZE = 5000
+
+# the tables a reflection covers: the named tables of the schema (or all of them if
+# none are named), plus every table they reference by foreign key, transitively
+SCHEMA_FINGERPRINT_TABLES_QUERY = """
+    WITH RECURSIVE reflected(oid) AS (
+        SELECT c.oid
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema
+          AND c.relkind IN ('r', 'p')
+          AND (CAST(:all_tables AS boolean) OR c.relname = ANY(CAST(:tables AS text[])))
+        UNION
+        SELECT con.confrelid
+        FROM pg_constraint con
+        JOIN reflected r ON con.conrelid = r.oid
+        WHERE con.contype = 'f'
+    )
+    SELECT oid FROM reflected
+"""
+
+SCHEMA_FINGERPRINT_QUERIES = [
+    """
+    SELECT n.nspname, c.relname, a.attname, format_type(a.atttypid, a.atttypmod),
+           a.attnotnull, pg_get_expr(d.adbin, d.adrelid), a.attnum
+    FROM pg_attribute a
+    JOIN pg_class c ON c.oid = a.attrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+    WHERE a.attrelid = ANY(CAST(:oids AS oid[])) AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY n.nspname, c.relname, a.attnum
+    """,
+    """
+    SELECT n.nspname, c.relname, con.conname, pg_get_constraintdef(con.oid)
+    FROM pg_constraint con
+    JOIN pg_class c ON c.oid = con.conrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE con.conrelid = ANY(CAST(:oids AS oid[]))
+    ORDER BY n.nspname, c.relname, con.conname
+    """,
+    """
+    SELECT n.nspname, c.relname, i.relname, pg_get_indexdef(x.indexrelid)
+    FROM pg_index x
+    JOIN pg_class c ON c.oid = x.indrelid
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE x.indrelid = ANY(CAST(:oids AS oid[]))
+    ORDER BY n.nspname, c.relname, i.relname
+    """,
+]
+
 
 class DeduplicatorService(object):
+    """Content-hash index of the files we have ingested, so that a file whose
+    content we already hold (under any name) can be recognized, and copied from the
+    object holding it rather than uploaded again.
+
+    The index lives in a SQLite file (<index_file>) mapping each content hash to
+    the id and filename of the asset first registered with it. An entry is only
+    good while that asset's object holds the content, so entries must be dropped
+    when their asset is deleted (purge_assets) or its file is about to be
+    overwritten (purge_files); partition_files() can also check them against the
+    live assets as it goes. File hashes are computed in chunks, and
+    cached in the same file by (filename, size, mtime), so a file is only read
+    once however many pipeline stages ask about it. Init params:
+
+        index_file      path of the SQLite index (created if need be)
+        hash_algorithm  any hashlib algorithm (default md5)
+        hash_workers    number of files hashed concurrently by hash_files() (default 4)
+    """
+
+    SQL_PARAM_LIMIT = 500
+
     def __init__(self, **kwargs):
-        pass
-        """
-        PLACEHOLDER: load all item attributes into dictionary (keyed by MDS hashes)
-        
+        if not kwargs.get("index_file"):
+            raise Exception('"index_file" is a required parameter for DeduplicatorService.')
+
+        self.index_file = kwargs["index_file"]
+        self.hash_algorithm = kwargs.get("hash_algorithm", "md5")
+        self.hash_workers = int(kwargs.get("hash_workers", 4))
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.index_file, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS content_index (
+                    content_hash TEXT PRIMARY KEY,
+                    asset_id TEXT NOT NULL,
+                    filename TEXT,
+                    registered_ts TEXT
+                ) WITHOUT ROWID"""
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS content_index_asset_idx ON content_index (asset_id)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS content_index_filename_idx ON content_index (filename)")
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS file_hashes (
+                    filename TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL
+                ) WITHOUT ROWID"""
+            )
+
+    def hash_file(self, filename):
+        stat = os.stat(filename)
+
+        with self.lock:
+            cached = self.db.execute(
+                "SELECT content_hash FROM file_hashes WHERE filename = ? AND size = ? AND mtime_ns = ?",
+                (filename, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+
+        if cached:
+            return cached[0]
+
+        content_hash = utils.hash_file(filename, self.hash_algorithm)
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO file_hashes (filename, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+                (filename, stat.st_size, stat.st_mtime_ns, content_hash),
+            )
+
+        return content_hash
+
+    def lookup(self, content_hash):
+        """Return the id of the asset registered with <content_hash>, or None."""
+
+        with self.lock:
+            record = self.db.execute(
+                "SELECT asset_id FROM content_index WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+
+        return record[0] if record else None
+
+    def check_batch(self, content_hashes):
+        """Return a dict mapping those of <content_hashes> already in the index to their asset ids."""
+
+        content_hashes = list(dict.fromkeys(content_hashes))
+        known_hashes = {}
+
+        with self.lock:
+            for offset in range(0, len(content_hashes), self.SQL_PARAM_LIMIT):
+                chunk = content_hashes[offset : offset + self.SQL_PARAM_LIMIT]
+                query = "SELECT content_hash, asset_id FROM content_index WHERE content_hash IN (%s)" % ",".join(
+                    "?" * len(chunk)
+                )
+                known_hashes.update(self.db.execute(query, chunk).fetchall())
+
+        return known_hashes
+
+    def register(self, content_hash, asset_id, filename=None):
+        """Index <content_hash> under <asset_id>, unless it is already indexed.
+        Returns the asset id the hash is indexed under."""
+
+        self.register_many([(content_hash, asset_id, filename)])
+        return self.lookup(content_hash)
+
+    def register_many(self, entries):
+        """Index a batch of (content_hash, asset_id, filename) entries in one transaction.
+        Hashes which are already indexed keep their original asset id."""
+
+        registered_ts = datetime.datetime.now().isoformat()
+
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO content_index (content_hash, asset_id, filename, registered_ts) VALUES (?, ?, ?, ?)",
+                    [(content_hash, str(asset_id), filename, registered_ts) for content_hash, asset_id, filename in entries],
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def purge(self, column, values):
+        """Drop the index entries whose <column> (asset_id or filename) is one of <values>."""
+
+        values = [str(value) for value in values]
+
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for offset in range(0, len(values), self.SQL_PARAM_LIMIT):
+                    chunk = values[offset : offset + self.SQL_PARAM_LIMIT]
+                    self.db.execute(
+                        "DELETE FROM content_index WHERE %s IN (%s)" % (column, ",".join("?" * len(chunk))), chunk
+                    )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def purge_assets(self, asset_ids):
+        """Drop the index entries of <asset_ids> (assets which have been deleted), so
+        that their content is treated as new again."""
+
+        self.purge("asset_id", asset_ids)
+
+    def purge_files(self, filenames):
+        """Drop the index entries of the assets stored under <filenames>, whose objects
+        are about to be overwritten (with new content) by an upload."""
+
+        self.purge("filename", filenames)
+
+    def hash_files(self, filenames):
+        """Return the content hashes of <filenames>, in order (None for a file which
+        couldn't be hashed)."""
+
+        def safe_hash(filename):
+            try:
+                return self.hash_file(filename)
+            except Exception as err:
+                mlog_err(err, issue="Error hashing file for deduplication.", filename=filename)
+                return None
+
+        if self.hash_workers > 1 and len(filenames) > 1:
+            with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+                return list(executor.map(safe_hash, filenames))
+
+        return [safe_hash(filename) for filename in filenames]
+
+    def partition_files(self, filenames, live_assets=None):
+        """Split a batch of files into new files and duplicates.
+
+        Returns (new_files, duplicates): new_files maps each new filename to its content
+        hash (None if it couldn't be hashed), and duplicates maps each duplicate filename
+        to the id of the indexed asset already holding its content. Files in the batch
+        which share content with one another but not with the index are all new.
+
+        <live_assets>, if given, is called with the set of asset ids the batch matched
+        in the index, and returns those of them which are still live; the entries of
+        the others are purged, and their files treated as new.
         """
 
+        content_hashes = self.hash_files(filenames)
+        known_hashes = self.check_batch([h for h in content_hashes if h is not None])
+
+        if live_assets and known_hashes:
+            live_asset_ids = live_assets(set(known_hashes.values()))
+            stale_asset_ids = {asset_id for asset_id in known_hashes.values() if asset_id not in live_asset_ids}
+            if stale_asset_ids:
+                mlog("+++ purging deduplication index entries of deleted assets.", assets=len(stale_asset_ids))
+                self.purge_assets(stale_asset_ids)
+                known_hashes = {h: asset_id for h, asset_id in known_hashes.items() if asset_id not in stale_asset_ids}
+
+        new_files = {}
+        duplicates = {}
+
+        for filename, content_hash in zip(filenames, content_hashes):
+            if content_hash in known_hashes:
+                duplicates[filename] = known_hashes[content_hash]
+            else:
+                new_files[filename] = content_hash
+
+        return new_files, duplicates
+
+
 class InfraLookupService(object):
+    """Looks up infrastructure assets (Terraform outputs) from <infra_datafile>.
+
+    Rather than parsing the whole file up front, the outputs are compiled once into
+    <index_file> (default: <infra_datafile>.idx), a binary file holding a table of
+    keys sorted by their UTF-8 bytes, followed by each output's JSON record. The index
+    is memory-mapped and binary-searched, and a record is decoded only when its key is
+    first looked up; after that, the decoded record is memoized.
+
+    At most every <check_interval> seconds (default 5), a lookup re-stats the
+    source file; if it has changed, the index is recompiled and the memo dropped.
+
+    Index layout (little-endian):
+        header:  magic "RQKV", format version (u32), key count (u32),
+                 source file size (i64), source file mtime in ns (i64)
+        entries: key count x (key offset, key length, value offset, value length), all u32
+        data:    the key and value bytes the entries point into
+    """
+
+    INDEX_MAGIC = b"RQKV"
+    INDEX_VERSION = 1
+    INDEX_HEADER = struct.Struct("<4sIIqq")
+    INDEX_ENTRY = struct.Struct("<IIII")
+
     def __init__(self, **kwargs):
         if not kwargs.get('infra_datafile'):
             raise Exception('"infra_datafile" is a required parameter for InfraLookupService.')
 
-        self.infra_data = None
+        self.infra_datafile = kwargs['infra_datafile']
+        self.index_file = kwargs.get('index_file') or f"{self.infra_datafile}.idx"
+        self.check_interval = float(kwargs.get('check_interval', 5))
+
+        self.lock = threading.Lock()
+        self.index = None
+        self.source_signature = None
+        self.last_check = time.monotonic()
+
+        self.open_index()
+
+    @staticmethod
+    def file_signature(filename):
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    @classmethod
+    def compile_index(cls, infra_datafile, index_file):
+        """Compile the JSON infra outputs in <infra_datafile> into <index_file>."""
+
+        source_size, source_mtime_ns = cls.file_signature(infra_datafile)
+        with open(infra_datafile, 'rb') as f:
+            infra_data = codec.loads(f.read())
 
-        with open(kwargs['infra_datafile'], 'r') as f:
-            rawdata = f.read()
-            self.infra_data = json.loads(rawdata)
+        items = sorted((str(key).encode('utf-8'), codec.dumps(record).encode('utf-8'))
+                       for key, record in infra_data.items())
+
+        entries = []
+        data_offset = cls.INDEX_HEADER.size + cls.INDEX_ENTRY.size * len(items)
+        for key_bytes, value_bytes in items:
+            entries.append((data_offset, len(key_bytes), data_offset + len(key_bytes), len(value_bytes)))
+            data_offset += len(key_bytes) + len(value_bytes)
+
+        # per-process, so that concurrent compiles never write into each other's file
+        temp_filename = f"{index_file}.{os.getpid()}.tmp"
+        try:
+            with open(temp_filename, 'wb') as f:
+                f.write(cls.INDEX_HEADER.pack(cls.INDEX_MAGIC, cls.INDEX_VERSION, len(items), source_size, source_mtime_ns))
+                for entry in entries:
+                    f.write(cls.INDEX_ENTRY.pack(*entry))
+                for key_bytes, value_bytes in items:
+                    f.write(key_bytes)
+                    f.write(value_bytes)
+
+            os.replace(temp_filename, index_file)
+
+        except Exception:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+    def read_index(self, source_signature):
+        """Map the index file, returning (index_map, key_count, memo), or None if there
+        is no usable index for the source file's current version."""
+
+        try:
+            with open(self.index_file, 'rb') as f:
+                index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except (OSError, ValueError):
+            return None
+
+        if len(index_map) < self.INDEX_HEADER.size:
+            return None
+
+        magic, version, key_count, source_size, source_mtime_ns = self.INDEX_HEADER.unpack_from(index_map, 0)
+        if (magic, version, (source_size, source_mtime_ns)) != (self.INDEX_MAGIC, self.INDEX_VERSION, source_signature):
+            return None
+
+        return index_map, key_count, {}
+
+    def open_index(self):
+        source_signature = self.file_signature(self.infra_datafile)
+
+        index = self.read_index(source_signature)
+        if index is None:
+            self.compile_index(self.infra_datafile, self.index_file)
+            index = self.read_index(source_signature)
+
+            if index is None:
+                raise Exception(f'Unable to read compiled infra index {self.index_file}.')
+
+        # the map, key count and memo are swapped in together, so that a lookup running
+        # across a reload never memoizes an old record for the new index; the old map is
+        # closed once no lookup references it
+        self.index = index
+        self.source_signature = source_signature
+
+    def check_for_changes(self):
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval:
+            return
+
+        with self.lock:
+            if now - self.last_check < self.check_interval:
+                return
+
+            self.last_check = now
+            if self.file_signature(self.infra_datafile) != self.source_signature:
+                mlog('+++ infra data file changed; recompiling index.', infra_datafile=self.infra_datafile)
+                self.open_index()
+
+    def find_record(self, asset_key, index_map, key_count):
+        key_bytes = str(asset_key).encode('utf-8')
+
+        low, high = 0, key_count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, value_length = self.INDEX_ENTRY.unpack_from(
+                index_map, self.INDEX_HEADER.size + middle * self.INDEX_ENTRY.size
+            )
+            middle_key = index_map[key_offset:key_offset + key_length]
+
+            if middle_key < key_bytes:
+                low = middle + 1
+            elif middle_key > key_bytes:
+                high = middle
+            else:
+                return codec.loads(index_map[value_offset:value_offset + value_length])
+
+        return None
 
     def lookup_infra_asset(self, asset_key):
-        
-        record =  self.infra_data.get(asset_key)
+        self.check_for_changes()
+
+        index_map, key_count, memo = self.index
+        if asset_key in memo:
+            record = memo[asset_key]
+        else:
+            record = self.find_record(asset_key, index_map, key_count)
+            memo[asset_key] = record
+
         if record:
             return record['value']
         
         return 'NO_SUCH_ASSET'
     
 
+CachedSecret = namedtuple("CachedSecret", "value expires_at refresh_at")
+
+
 class SimpleAWSSecretService(object):
+    """Reads (JSON) secrets from AWS Secrets Manager, caching each one for a TTL.
+
+    The boto3 client is only created on first use, and can be replaced by assigning
+    to asm_client (for instance, with a local stub exposing get_secret_value()).
+    Init params:
+
+        aws_region      required
+        profile         AWS profile to use (default: the default session)
+        secret_ttl      seconds to cache each secret for (default 300; 0 disables caching)
+        secret_ttls     per-secret TTL overrides, as a {secret_name: seconds} mapping
+        refresh_ahead   when a secret is read within this many seconds of expiring, it is
+                        refetched in the background, so readers never wait on a refresh
+                        (default 30; capped at half the secret's TTL)
+
+    Concurrent reads of a secret that is missing or expired share a single fetch.
+    """
+
     def __init__(self, **kwargs):
         if not kwargs.get("aws_region"):
             raise Exception(
                 '"aws_region" is a required keyword argument for SimpleAWSSecretService.'
             )
 
-        region = kwargs["aws_region"]
-        profile = kwargs.get("profile", "default")
+        self.region = kwargs["aws_region"]
+        self.profile = kwargs.get("profile", "default")
+        self.secret_ttl = float(kwargs.get("secret_ttl", 300))
+        self.secret_ttls = {name: float(ttl) for name, ttl in (kwargs.get("secret_ttls") or {}).items()}
+        self.refresh_ahead = float(kwargs.get("refresh_ahead", 30))
 
-        if profile == "default":
-            # logger.debug('creating boto3 session with no profile spec...')
-            b3session = boto3.session.Session()
-        else:
-            # logger.debug('creating boto3 session with profile "%s"...' % profile)
-            b3session = boto3.session.Session(profile_name=profile)
+        self._asm_client = None
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.fetch_locks = {}
+        self.refreshing = set()
+        self.stats = {"hits": 0, "misses": 0, "fetches": 0, "background_refreshes": 0, "fetch_errors": 0}
 
-        self.asm_client = b3session.client("secretsmanager", region_name=region)
+    @property
+    def asm_client(self):
+        if self._asm_client is None:
+            with self.lock:
+                if self._asm_client is None:
+                    if self.profile == "default":
+                        b3session = boto3.session.Session()
+                    else:
+                        b3session = boto3.session.Session(profile_name=self.profile)
 
-    def get_secret(self, secret_name):
+                    self._asm_client = b3session.client("secretsmanager", region_name=self.region)
+
+        return self._asm_client
+
+    @asm_client.setter
+    def asm_client(self, client):
+        self._asm_client = client
+
+    def ttl_for(self, secret_name):
+        return self.secret_ttls.get(secret_name, self.secret_ttl)
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def fetch_secret(self, secret_name):
         secret_value = self.asm_client.get_secret_value(SecretId=secret_name)
-        return json.loads(secret_value["SecretString"])
+        return codec.loads(secret_value["SecretString"])
+
+    def load_secret(self, secret_name, force=False):
+        """Fetch <secret_name> into the cache, unless (and <force> is not set) another
+        caller has just done so while we waited for the secret's fetch lock."""
+
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(secret_name, threading.Lock())
+
+        with fetch_lock:
+            cached = self.cache.get(secret_name)
+            if cached and not force and time.monotonic() < cached.expires_at:
+                return cached.value
+
+            try:
+                value = self.fetch_secret(secret_name)
+            except Exception:
+                self.count("fetch_errors")
+                raise
+
+            self.count("fetches")
+
+            # a refresh window as long as the TTL would have every read start a refresh
+            ttl = self.ttl_for(secret_name)
+            expires_at = time.monotonic() + ttl
+            self.cache[secret_name] = CachedSecret(value, expires_at, expires_at - min(self.refresh_ahead, ttl / 2))
+            return value
+
+    def refresh_secret(self, secret_name):
+        try:
+            self.load_secret(secret_name, force=True)
+            self.count("background_refreshes")
+
+        except Exception as err:
+            # keep serving the cached value; get_secret() will refetch once it expires
+            mlog_err(err, issue="Error refreshing secret.", secret_name=secret_name)
+
+        finally:
+            with self.lock:
+                self.refreshing.discard(secret_name)
+
+    def start_refresh(self, secret_name):
+        with self.lock:
+            if secret_name in self.refreshing:
+                return
+            self.refreshing.add(secret_name)
+
+        threading.Thread(target=self.refresh_secret, args=(secret_name,), daemon=True).start()
+
+    def get_secret(self, secret_name):
+        cached = self.cache.get(secret_name)
+
+        if cached:
+            now = time.monotonic()
+            if now < cached.expires_at:
+                self.count("hits")
+                if now >= cached.refresh_at:
+                    self.start_refresh(secret_name)
+                return cached.value
+
+        self.count("misses")
+        return self.load_secret(secret_name)
+
+    def invalidate(self, secret_name=None):
+        """Drop <secret_name> (or, with no name, every secret) from the cache."""
+
+        with self.lock:
+            if secret_name is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(secret_name, None)
+
+    def cache_stats(self):
+        with self.lock:
+            return dict(self.stats, cached_secrets=len(self.cache))
+
+
+class PoolStats(object):
+    """Connection-pool checkout counters, maintained by pool event listeners."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections_created = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connections_created += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checkins += 1
+            self.checked_out -= 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "connections_created": self.connections_created,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "checked_out": self.checked_out,
+                "peak_checked_out": self.peak_checked_out,
+            }
+
+
+class EngineRegistry(object):
+    """Process-wide registry of SQLAlchemy engines, keyed by connection URL.
+
+    Every service object pointed at the same database shares one engine (and so
+    one connection pool), and one reflection pass per schema and table set.
+    Pool options are taken from whichever service registers the URL first.
+    """
+
+    lock = threading.RLock()
+    engines = {}
+    pool_stats = {}
+    reflections = {}
+
+    @classmethod
+    def get_engine(cls, db_url, **pool_options):
+        with cls.lock:
+            engine = cls.engines.get(db_url)
+            if engine is None:
+                engine = sqla.create_engine(db_url, echo=False, **pool_options)
+
+                stats = PoolStats()
+                event.listen(engine.pool, "connect", stats.on_connect)
+                event.listen(engine.pool, "checkout", stats.on_checkout)
+                event.listen(engine.pool, "checkin", stats.on_checkin)
+
+                cls.engines[db_url] = engine
+                cls.pool_stats[db_url] = stats
+
+            return engine
+
+    @classmethod
+    def get_reflection(cls, reflection_key, reflect_function):
+        with cls.lock:
+            if reflection_key not in cls.reflections:
+                cls.reflections[reflection_key] = reflect_function()
+
+            return cls.reflections[reflection_key]
+
+    @classmethod
+    def get_pool_stats(cls, db_url):
+        engine = cls.engines.get(db_url)
+        if engine is None:
+            return {}
+
+        stats = cls.pool_stats[db_url].to_dict()
+        stats["pool_status"] = engine.pool.status()
+        return stats
+
+    @classmethod
+    def dispose(cls, db_url):
+        with cls.lock:
+            engine = cls.engines.pop(db_url, None)
+            cls.pool_stats.pop(db_url, None)
+            for key in [k for k in cls.reflections if k[0] == db_url]:
+                cls.reflections.pop(key)
+
+        if engine is not None:
+            engine.dispose()
 
 
 class PostgreSQLService(object):
@@ -108,11 +740,29 @@ class PostgreSQLService(object):
         self.username = kwargs["username"]
         self.password = kwargs["password"]
         self.schema = kwargs.get("schema", "public")
-        self.metadata = None
         self.engine = None
         self.session_factory = None
-        self.Base = None
         self.url = None
+        self._metadata = None
+        self._Base = None
+
+        # reflect only these tables (default: the whole schema)
+        self.reflect_tables = utils.to_list(kwargs.get("reflect_tables"))
+
+        # if set, reflected metadata is pickled here, keyed by a fingerprint of the schema
+        self.reflection_cache_dir = kwargs.get("reflection_cache_dir")
+
+        # if set, reflection is deferred until metadata or Base is first accessed
+        lazy_reflection = utils.to_boolean(kwargs.get("lazy_reflection", False))
+
+        # options for the connection pool shared by every service using this database
+        pool_options = {}
+        if kwargs.get("pool_size") is not None:
+            pool_options["pool_size"] = int(kwargs["pool_size"])
+        if kwargs.get("max_overflow") is not None:
+            pool_options["max_overflow"] = int(kwargs["max_overflow"])
+        if kwargs.get("pool_pre_ping") is not None:
+            pool_options["pool_pre_ping"] = utils.to_boolean(kwargs["pool_pre_ping"])
 
         url_template = "{db_type}://{user}:{passwd}@{host}:{port}/{database}"
         db_url = url_template.format(
@@ -124,42 +774,142 @@ class PostgreSQLService(object):
             database=self.db_name,
         )
 
-        retries = 0
-        connected = False
-        while not connected and retries < 3:
-            try:
-                self.engine = sqla.create_engine(db_url, echo=False)
-                self.metadata = MetaData(schema=self.schema)
-                self.Base = automap_base()
-                self.Base.prepare(self.engine, reflect=True)
-                self.metadata.reflect(bind=self.engine)
-                self.session_factory = sessionmaker(
-                    bind=self.engine,
-                    autoflush=False,
-                    autocommit=False,
-                    expire_on_commit=False,
-                )
-
-                # this is required. See comment in SimpleRedshiftService
-                connection = self.engine.connect()
-                connection.close()
-                connected = True
-                mlog("+++ Connected to PostgreSQL DB.")
-                self.url = db_url
+        self.url = db_url
+        connect_policy = utils.RetryPolicy(
+            max_attempts=kwargs.get("connect_attempts", 3),
+            base_delay=kwargs.get("connect_retry_delay", 1.0),
+            deadline=kwargs.get("connect_deadline"),
+            on_retry=self.log_connect_error,
+        )
 
-            except Exception as err:
-                print(err, file=sys.stderr)
-                print(err.__class__.__name__, file=sys.stderr)
-                print(err.__dict__, file=sys.stderr)
-                time.sleep(1)
-                retries += 1
+        try:
+            connect_policy.call(self.connect_engine, lazy_reflection, **pool_options)
 
-        if not connected:
+        except Exception as err:
+            self.log_connect_error(err)
             raise Exception(
                 "!!! Unable to connect to PostgreSQL db on host %s at port %s."
                 % (self.host, self.port)
             )
 
+    def connect_engine(self, lazy_reflection, **pool_options):
+        self.engine = EngineRegistry.get_engine(self.url, **pool_options)
+        if not lazy_reflection:
+            self.reflect()
+
+        self.session_factory = sessionmaker(
+            bind=self.engine,
+            autoflush=False,
+            autocommit=False,
+            expire_on_commit=False,
+        )
+
+        # this is required. See comment in SimpleRedshiftService
+        connection = self.engine.connect()
+        connection.close()
+        mlog("+++ Connected to PostgreSQL DB.")
+
+    def log_connect_error(self, err, *retry_info):
+        print(err, file=sys.stderr)
+        print(err.__class__.__name__, file=sys.stderr)
+        print(err.__dict__, file=sys.stderr)
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self.reflect()
+        return self._metadata
+
+    @property
+    def Base(self):
+        if self._Base is None:
+            self.reflect()
+        return self._Base
+
+    def reflect(self):
+        """Populate metadata and the automapped Base in a single reflection pass,
+        shared with any other service reflecting the same tables of this database."""
+
+        reflection_key = (self.url, self.schema, tuple(sorted(self.reflect_tables)))
+        self._metadata, self._Base = EngineRegistry.get_reflection(
+            reflection_key, self.reflect_schema
+        )
+
+    def reflect_schema(self):
+        """Reflect the schema, or load it from the on-disk cache if one is
+        configured and still matches the schema."""
+
+        metadata = None
+        cache_file = None
+
+        if self.reflection_cache_dir:
+            cache_file = self.reflection_cache_filename()
+            metadata = self.load_cached_metadata(cache_file)
+
+        if metadata is None:
+            metadata = MetaData(schema=self.schema)
+            metadata.reflect(bind=self.engine, only=self.reflect_tables or None)
+
+            if cache_file:
+                self.save_cached_metadata(metadata, cache_file)
+
+        Base = automap_base(metadata=metadata)
+        Base.prepare()
+
+        return metadata, Base
+
+    def pool_stats(self):
+        return EngineRegistry.get_pool_stats(self.url)
+
+    def schema_fingerprint(self):
+        fingerprint = hashlib.md5()
+        fingerprint.update(sqla.__version__.encode())
+        fingerprint.update(",".join(sorted(self.reflect_tables)).encode())
+
+        with self.engine.connect() as connection:
+            # filter in SQL, so that the cost depends on the tables reflected, not the schema size
+            oids = [
+                row.oid for row in connection.execute(sqla.text(SCHEMA_FINGERPRINT_TABLES_QUERY), {
+                    "schema": self.schema,
+                    "all_tables": not self.reflect_tables,
+                    "tables": list(self.reflect_tables),
+                })
+            ]
+
+            for query in SCHEMA_FINGERPRINT_QUERIES:
+                for row in connection.execute(sqla.text(query), {"oids": oids}):
+                    fingerprint.update(repr(tuple(row)).encode())
+
+        return fingerprint.hexdigest()
+
+    def reflection_cache_filename(self):
+        return os.path.join(
+            self.reflection_cache_dir,
+            f"{self.db_name}.{self.schema}.{self.schema_fingerprint()}.metadata.pkl",
+        )
+
+    def load_cached_metadata(self, cache_file):
+        if not os.path.isfile(cache_file):
+            return None
+
+        try:
+            with open(cache_file, "rb") as f:
+                metadata = pickle.load(f)
+            mlog("+++ Loaded reflected schema from cache.", cache_file=cache_file)
+            return metadata
+
+        except Exception as err:
+            mlog_err(err, issue="Unable to load cached schema; reflecting instead.", cache_file=cache_file)
+            return None
+
+    def save_cached_metadata(self, metadata, cache_file):
+        os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(metadata, f)
+
+        os.replace(tmp_file, cache_file)
+
     @contextmanager
     def txn_scope(self):
         session = self.session_factory()
@@ -180,6 +930,66 @@ class PostgreSQLService(object):
         finally:
             connection.close()
 
+    def export_query(self, table_name, *columns, **kwargs):
+        """Build a SELECT of <columns> (default: all) from <table_name>, restricted to
+        rows where every column named in the "where_null" kwarg IS NULL."""
+
+        table = sqla.table(table_name, *[sqla.column(c) for c in columns], schema=self.schema)
+        query = sqla.select(*table.c) if columns else sqla.select(sqla.text("*")).select_from(table)
+
+        for column_name in kwargs.get("where_null") or []:
+            query = query.where(sqla.column(column_name).is_(None))
+
+        return query
+
+    def stream_rows(self, table_name, *columns, **kwargs):
+        """Yield the rows of <table_name> as dicts, fetching <fetch_size> rows at a
+        time through a server-side cursor. Accepts the same kwargs as export_query."""
+
+        fetch_size = int(kwargs.get("fetch_size") or DEFAULT_EXPORT_FETCH_SIZE)
+        query = self.export_query(table_name, *columns, **kwargs)
+
+        with self.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True, yield_per=fetch_size
+            ).execute(query)
+
+            for row in result.mappings():
+                yield dict(row)
+
+    def export_jsonl(self, table_name, file_handle, *columns, **kwargs):
+        """Write the rows of <table_name> to <file_handle> as JSONL, one row per line.
+        With use_copy=True, Postgres renders the JSON itself and streams it to us via
+        COPY ... TO STDOUT; otherwise rows are streamed with stream_rows().
+        Returns the number of rows written (None in COPY mode)."""
+
+        if kwargs.get("use_copy"):
+            query = self.export_query(table_name, *columns, **kwargs).subquery("t")
+            json_query = sqla.select(sqla.func.row_to_json(sqla.literal_column("t"))).select_from(query)
+            compiled_query = json_query.compile(
+                dialect=self.engine.dialect, compile_kwargs={"literal_binds": True}
+            )
+
+            # CSV mode with quote and delimiter characters that cannot appear in JSON
+            # output, so that each row is copied out verbatim
+            copy_stmt = f"COPY ({compiled_query}) TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+
+            raw_connection = self.engine.raw_connection()
+            try:
+                with raw_connection.cursor() as cursor:
+                    cursor.copy_expert(copy_stmt, file_handle)
+            finally:
+                raw_connection.close()
+            return None
+
+        row_count = 0
+        for row in self.stream_rows(table_name, *columns, **kwargs):
+            file_handle.write(codec.dumps(row))
+            file_handle.write("\n")
+            row_count += 1
+
+        return row_count
+
 
 class S3Key(object):
     def __init__(self, bucket_name, s3_object_path):
@@ -214,6 +1024,7 @@ class S3Service(object):
 
         self.local_tmp_path = kwreader.get_value("local_temp_path")
         self.region = kwreader.get_value("region")
+        self.transfer_config = self.create_transfer_config(**kwargs)
         self.s3session = None
         self.aws_access_key_id = None
         self.aws_secret_access_key = None
@@ -257,6 +1068,18 @@ class S3Service(object):
                 "Unsupported or unspecified auth method for S3. Must be one of (basic | profile | iam)"
             )
 
+    def create_transfer_config(self, **kwargs):
+        """Build the boto3 TransferConfig used for uploads and downloads from the
+        optional init params multipart_threshold, multipart_chunksize (both in bytes)
+        and max_concurrency (threads per transfer)."""
+
+        transfer_settings = {}
+        for param in ["multipart_threshold", "multipart_chunksize", "max_concurrency"]:
+            if kwargs.get(param) is not None:
+                transfer_settings[param] = int(kwargs[param])
+
+        return TransferConfig(**transfer_settings)
+
     def upload_object(self, local_filename, bucket_name, bucket_path=None):
         s3_path = None
         with open(local_filename, "rb") as data:
@@ -265,9 +1088,20 @@ class S3Service(object):
                 s3_path = os.path.join(bucket_path, base_filename)
             else:
                 s3_path = base_filename
-            self.s3client.upload_fileobj(data, bucket_name, s3_path)
+            self.s3client.upload_fileobj(
+                data, bucket_name, s3_path, Config=self.transfer_config
+            )
         return S3Key(bucket_name, s3_path)
 
+    def copy_object(self, source_bucket, source_key, bucket_name, bucket_path):
+        """Copy an object within S3, without transferring its data through this host.
+        Large objects are copied as parts, per our TransferConfig."""
+
+        self.s3client.copy(
+            {"Bucket": source_bucket, "Key": source_key}, bucket_name, bucket_path, Config=self.transfer_config
+        )
+        return S3Key(bucket_name, bucket_path)
+
     def upload_json(self, data_dict, bucket_name, bucket_path):
         binary_data = bytes(json.dumps(data_dict), "utf-8")
         self.s3client.put_object(Body=binary_data, Bucket=bucket_name, Key=bucket_path)
@@ -277,13 +1111,62 @@ class S3Service(object):
         self.s3client.put_object(Body=bytes_obj, Bucket=bucket_name, Key=s3_key)
         return s3_key
 
-    def download_file(self, bucket_name, s3_key_object, local_filename):
+    def local_file_matches(self, local_filename, remote_size, remote_etag):
+        if not os.path.isfile(local_filename):
+            return False
+
+        if os.path.getsize(local_filename) != remote_size:
+            return False
+
+        num_parts = int(remote_etag.split("-")[1]) if "-" in remote_etag else 1
+        local_etag = utils.s3_etag_for_file(
+            local_filename, self.transfer_config.multipart_chunksize, num_parts
+        )
+        return local_etag == remote_etag
+
+    def download_file(self, bucket_name, s3_key_object, local_filename, skip_if_unchanged=False):
+        """Stream an S3 object to <local_filename>. Large objects are fetched as
+        ranged parts in parallel, per our TransferConfig. The download goes to a
+        temporary file which replaces <local_filename> only once its size, its
+        MD5 (for single-part objects) and the object's ETag have been re-checked.
+
+        If skip_if_unchanged is set and the local file already matches the
+        object's size and ETag, the download is skipped.
+        """
+
         s3_key_string = str(s3_key_object)
         try:
-            obj = self.s3client.get_object(Bucket=bucket_name, Key=s3_key_string)
-            data = obj["Body"].read().decode("utf-8")
-            with open(local_filename, "w") as f:
-                f.write(data)
+            obj_info = self.s3client.head_object(Bucket=bucket_name, Key=s3_key_string)
+            remote_size = obj_info["ContentLength"]
+            remote_etag = obj_info["ETag"].strip('"')
+
+            if skip_if_unchanged and self.local_file_matches(local_filename, remote_size, remote_etag):
+                mlog(f'+++ local file {local_filename} matches S3 object "{s3_key_string}"; skipping download.')
+                return local_filename
+
+            partial_filename = f"{local_filename}.part"
+            self.s3client.download_file(
+                bucket_name, s3_key_string, partial_filename, Config=self.transfer_config
+            )
+
+            # the parts of a large object are fetched separately; make sure it did not change underneath us
+            current_info = self.s3client.head_object(Bucket=bucket_name, Key=s3_key_string)
+            if current_info["ETag"] != obj_info["ETag"]:
+                os.remove(partial_filename)
+                raise Exception("S3 object was modified during download.")
+
+            local_size = os.path.getsize(partial_filename)
+            if local_size != remote_size:
+                os.remove(partial_filename)
+                raise Exception(
+                    f"Downloaded {local_size} bytes but the S3 object is {remote_size} bytes."
+                )
+
+            if "-" not in remote_etag and utils.hash_file(partial_filename) != remote_etag:
+                os.remove(partial_filename)
+                raise Exception("MD5 of downloaded file does not match the S3 object ETag.")
+
+            os.replace(partial_filename, local_filename)
             return local_filename
 
         except Exception as err:
@@ -291,6 +1174,38 @@ class S3Service(object):
                 f'Error of type {err.__class__.__name__} thrown while retrieving S3 object "{s3_key_string}": {err}'
             )
 
+    def delete_objects(self, bucket_name, s3_keys):
+        """Delete the given keys using batched DeleteObjects calls of up to 1000 keys.
+        Returns a dict with the list of keys deleted and a list of per-key errors;
+        a failed batch call is reported as an error for every key in that batch."""
+
+        status = {"deleted": [], "errors": []}
+        keys = [str(key) for key in s3_keys]
+
+        for offset in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            batch = keys[offset : offset + S3_DELETE_BATCH_SIZE]
+            try:
+                response = self.s3client.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+                )
+                errors = [
+                    {"key": e["Key"], "code": e.get("Code"), "message": e.get("Message")}
+                    for e in response.get("Errors", [])
+                ]
+
+            except Exception as err:
+                errors = [
+                    {"key": key, "code": err.__class__.__name__, "message": str(err)}
+                    for key in batch
+                ]
+
+            failed_keys = {e["key"] for e in errors}
+            status["deleted"].extend([key for key in batch if key not in failed_keys])
+            status["errors"].extend(errors)
+
+        return status
+
     def download_json(self, bucket_name, s3_key_string):
         status = {}
         try:
@@ -319,68 +1234,303 @@ class S3Service(object):
 LOOKUP_SVC_PARAM_NAMES = ["table_name", "key_columns"]
 
 
-class OLAPDimensionSvc(object):
-    def __init__(self, **kwargs):
-        self.pg_svc = PostgreSQLService(**kwargs)
-        self.dimensions_by_value = {}
-        self.dimensions_by_label = {}
+class DimensionTable(object):
+    """Compact in-memory copy of one OLAP dimension table (id, value, label).
 
-        for tbl_name in kwargs["dimension_tables"]:
-            self.dimensions_by_value[tbl_name] = self.load_dimension_values(
-                tbl_name, self.pg_svc
-            )
+    Row ids are held in a typed array, and each distinct label is stored once in an
+    interned label table which rows refer to by position. value_index and label_index
+    map the string form of each value and label to its row.
+    """
 
-        for tbl_name in kwargs["dimension_tables"]:
-            self.dimensions_by_label[tbl_name] = self.load_dimension_labels(
-                tbl_name, self.pg_svc
-            )
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.ids = array("q")
+        self.label_refs = array("I")
+        self.labels = []
+        self.value_index = {}
+        self.label_index = {}
+        self.id_lookup_array = None
 
-        mlog(
-            "+++ OLAP dimensions loaded:",
-            tables=[key for key in kwargs["dimension_tables"]],
+    @classmethod
+    def load(cls, table_name, db_svc):
+        table = getattr(db_svc.Base.classes, table_name).__table__
+        query = sqla.select(table.c.id, table.c.value, table.c.label)
+
+        dim_table = cls(table_name)
+        with db_svc.connect() as connection:
+            for record in connection.execute(query):
+                dim_table.add(record.id, record.value, record.label)
+
+        return dim_table
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, dim_id, value, label):
+        row = len(self.ids)
+        label = sys.intern(str(label))
+
+        labelled_row = self.label_index.get(label)
+        if labelled_row is None:
+            label_ref = len(self.labels)
+            self.labels.append(label)
+        else:
+            label_ref = self.label_refs[labelled_row]
+
+        self.ids.append(dim_id)
+        self.label_refs.append(label_ref)
+        self.value_index[str(value)] = row
+        self.label_index[label] = row
+        self.id_lookup_array = None
+
+    def id_for_value(self, value):
+        return self.ids[self.value_index[str(value)]]
+
+    def id_for_label(self, label):
+        return self.ids[self.label_index[str(label)]]
+
+    def label_for_value(self, value):
+        return self.labels[self.label_refs[self.value_index[str(value)]]]
+
+    def lookup_array(self, size=None):
+        """Return a dense value -> id numpy array (at least <size> long), in which
+        -1 marks values with no row. Values which are not non-negative integers
+        (a negative index would silently wrap around) are left out of the array.
+        """
+
+        if self.id_lookup_array is None:
+            rows_by_int_value = {}
+            for value, row in self.value_index.items():
+                try:
+                    int_value = int(value)
+                except ValueError:
+                    continue
+                if int_value >= 0:
+                    rows_by_int_value[int_value] = row
+
+            lookup_array = np.full(max(rows_by_int_value, default=-1) + 1, -1, dtype=np.int64)
+            for int_value, row in rows_by_int_value.items():
+                lookup_array[int_value] = self.ids[row]
+            self.id_lookup_array = lookup_array
+
+        if size is not None and size > len(self.id_lookup_array):
+            padding = np.full(size - len(self.id_lookup_array), -1, dtype=np.int64)
+            return np.concatenate([self.id_lookup_array, padding])
+
+        return self.id_lookup_array
+
+    def ids_for_values(self, values):
+        """Map an array of (non-negative integer) dimension values to an array of ids."""
+
+        lookup_array = self.lookup_array()
+
+        values = np.asarray(values, dtype=np.int64)
+        if values.size and (values.min() < 0 or values.max() >= len(lookup_array)):
+            raise KeyError(f"Value out of range for dimension table {self.table_name}.")
+
+        dim_ids = lookup_array[values]
+        if (dim_ids < 0).any():
+            raise KeyError(f"Value {values[dim_ids < 0][0]} not found in dimension table {self.table_name}.")
+
+        return dim_ids
+
+
+class CalendarLookup(object):
+    """Precomputed local-time calendar mapping epoch seconds to time dimension ids.
+
+    Built once from the loaded time dimensions, it covers every local day of the
+    years in the year dimension and holds:
+
+    - the UTC offset transitions of the local timezone over that range, found by
+      sampling the offset once a day and bisecting each change down to the second
+      (so transitions closer together than a day are not supported);
+    - a day table giving the (day, month, year) dimension ids of each local day;
+    - dense hour, minute and second id tables.
+
+    A timestamp is shifted to local seconds by its offset, then split into a day
+    (one table lookup) and the time of day (arithmetic), which matches what
+    datetime.fromtimestamp() would give without building a datetime.
+    """
+
+    SECONDS_PER_DAY = 86400
+
+    def __init__(self, dimensions_by_field):
+        year_values = [int(v) for v in dimensions_by_field["year"].value_index]
+        first_date = datetime.date(min(year_values), 1, 1)
+        last_date = datetime.date(max(year_values), 12, 31)
+
+        self.first_day = (first_date - datetime.date(1970, 1, 1)).days
+        self.last_day = (last_date - datetime.date(1970, 1, 1)).days
+
+        self.transitions, self.offsets = self.find_offset_transitions(
+            (self.first_day - 1) * self.SECONDS_PER_DAY,
+            (self.last_day + 2) * self.SECONDS_PER_DAY,
         )
 
-    def load_dimension_values(self, table_name, db_svc):
-        dim_data = {}
-        data_object = getattr(db_svc.Base.classes, table_name)
+        dates = [first_date + datetime.timedelta(days=n) for n in range(self.last_day - self.first_day + 1)]
+        self.date_ids = {
+            field: dimensions_by_field[field].lookup_array(size=max_value + 1)[
+                np.array([getattr(d, field) for d in dates], dtype=np.int64)
+            ]
+            for field, max_value in [("day", 31), ("month", 12), ("year", last_date.year)]
+        }
+        self.time_ids = {
+            field: dimensions_by_field[field].lookup_array(size=size)[:size]
+            for field, size in [("hour", 24), ("minute", 60), ("second", 60)]
+        }
+
+        self.transitions_array = np.array(self.transitions, dtype=np.int64)
+        self.offsets_array = np.array(self.offsets, dtype=np.int64)
+
+        # plain-list copies, which index faster than numpy arrays for single lookups
+        self.date_rows = list(zip(*(self.date_ids[field].tolist() for field in ["day", "month", "year"])))
+        self.hour_ids = self.time_ids["hour"].tolist()
+        self.minute_ids = self.time_ids["minute"].tolist()
+        self.second_ids = self.time_ids["second"].tolist()
+
+    @staticmethod
+    def utc_offset(timestamp):
+        local_time = datetime.datetime.fromtimestamp(timestamp)
+        utc_time = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(tzinfo=None)
+        return int((local_time - utc_time).total_seconds())
+
+    @classmethod
+    def find_offset_transitions(cls, start_ts, end_ts):
+        """Return parallel lists of the epoch seconds at which the local UTC offset
+        changes, and the offset in effect from each of them on."""
+
+        transitions = [start_ts]
+        offsets = [cls.utc_offset(start_ts)]
+
+        previous_ts = start_ts
+        for sample_ts in range(start_ts + cls.SECONDS_PER_DAY, end_ts + 1, cls.SECONDS_PER_DAY):
+            offset = cls.utc_offset(sample_ts)
+            if offset != offsets[-1]:
+                # the change happened in (previous_ts, sample_ts]; bisect to the exact second
+                low, high = previous_ts, sample_ts
+                while high - low > 1:
+                    middle = (low + high) // 2
+                    if cls.utc_offset(middle) == offsets[-1]:
+                        low = middle
+                    else:
+                        high = middle
+
+                transitions.append(high)
+                offsets.append(offset)
+
+            previous_ts = sample_ts
+
+        return transitions, offsets
+
+    def ids_for_timestamp(self, timestamp) -> dict:
+        timestamp = int(timestamp)
+        transition = max(bisect.bisect_right(self.transitions, timestamp) - 1, 0)
+
+        local_day, second_of_day = divmod(timestamp + self.offsets[transition], self.SECONDS_PER_DAY)
+        if not self.first_day <= local_day <= self.last_day:
+            raise KeyError(f"Timestamp {timestamp} is outside the range of the date dimensions.")
+
+        day_id, month_id, year_id = self.date_rows[local_day - self.first_day]
+        hour, second_of_hour = divmod(second_of_day, 3600)
+        minute, second = divmod(second_of_hour, 60)
+
+        data = {
+            "second": self.second_ids[second],
+            "minute": self.minute_ids[minute],
+            "hour": self.hour_ids[hour],
+            "day": day_id,
+            "month": month_id,
+            "year": year_id,
+        }
+
+        if -1 in data.values():
+            raise KeyError(f"No dimension value found for timestamp {timestamp}.")
+
+        return data
+
+    def ids_for_timestamps(self, timestamps) -> dict:
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+
+        transitions = np.maximum(np.searchsorted(self.transitions_array, timestamps, side="right") - 1, 0)
+        local_days, seconds_of_day = np.divmod(timestamps + self.offsets_array[transitions], self.SECONDS_PER_DAY)
+
+        out_of_range = (local_days < self.first_day) | (local_days > self.last_day)
+        if out_of_range.any():
+            raise KeyError(
+                f"Timestamp {timestamps[out_of_range][0]} is outside the range of the date dimensions."
+            )
 
-        with db_svc.txn_scope() as session:
-            resultset = session.query(data_object).all()
+        day_rows = local_days - self.first_day
+        data = {
+            "second": self.time_ids["second"][seconds_of_day % 60],
+            "minute": self.time_ids["minute"][seconds_of_day // 60 % 60],
+            "hour": self.time_ids["hour"][seconds_of_day // 3600],
+            "day": self.date_ids["day"][day_rows],
+            "month": self.date_ids["month"][day_rows],
+            "year": self.date_ids["year"][day_rows],
+        }
+
+        for field, dim_ids in data.items():
+            if (dim_ids < 0).any():
+                raise KeyError(
+                    f"No {field} dimension value found for timestamp {timestamps[dim_ids < 0][0]}."
+                )
 
-            for record in resultset:
-                dim_data[str(record.value)] = (record.id, record.label)
+        return data
 
-        return dim_data
 
-    def load_dimension_labels(self, table_name, db_svc):
-        dim_data = {}
-        data_object = getattr(db_svc.Base.classes, table_name)
+class OLAPDimensionSvc(object):
+    # (timestamp field, dimension table) pairs used by the timestamp lookups
+    TIME_DIMENSIONS = [
+        ("second", "dim_time_second"),
+        ("minute", "dim_time_minute"),
+        ("hour", "dim_time_hour"),
+        ("day", "dim_date_day"),
+        ("month", "dim_date_month"),
+        ("year", "dim_date_year"),
+    ]
 
-        with db_svc.txn_scope() as session:
-            resultset = session.query(data_object).all()
+    def __init__(self, **kwargs):
+        self.pg_svc = PostgreSQLService(**kwargs)
+        self.dimensions = {}
 
-            for record in resultset:
-                dim_data[str(record.label)] = (record.id, record.value)
+        for tbl_name in kwargs["dimension_tables"]:
+            self.dimensions[tbl_name] = DimensionTable.load(tbl_name, self.pg_svc)
 
-        return dim_data
+        # the precomputed calendar needs all of the time dimensions; if it cannot be
+        # built, the timestamp lookups fall back to datetime decomposition
+        self.calendar = None
+        if all(tbl_name in self.dimensions for _, tbl_name in self.TIME_DIMENSIONS):
+            try:
+                self.calendar = CalendarLookup(
+                    {field: self.dimensions[tbl_name] for field, tbl_name in self.TIME_DIMENSIONS}
+                )
+            except Exception as err:
+                mlog_err(err, issue="Cannot build the OLAP calendar lookup; using datetime lookups.")
+
+        mlog(
+            "+++ OLAP dimensions loaded:",
+            tables=[key for key in kwargs["dimension_tables"]],
+            calendar=self.calendar is not None,
+        )
 
     def dim_id_for_value(self, dim_table_name, value):
-        rltuple = self.dimensions_by_value[dim_table_name][str(value)]
-        return rltuple[0]
+        return self.dimensions[dim_table_name].id_for_value(value)
 
     def dim_id_for_label(self, dim_table_name, label):
-        rltuple = self.dimensions_by_label[dim_table_name][str(label)]
-        return rltuple[0]
+        return self.dimensions[dim_table_name].id_for_label(label)
 
     def dim_label_for_value(self, dim_table_name, value):
-        rltuple = self.dimensions[dim_table_name][str(value)]
-        return rltuple[1]
+        return self.dimensions[dim_table_name].label_for_value(value)
+
+    def dim_ids_from_datetime(self, source_timestamp) -> dict:
+        """Reference lookup: decompose the timestamp with datetime and look up
+        each time dimension by value."""
 
-    def get_dim_ids_for_timestamp(self, source_timestamp) -> dict:
         datestamp = datetime.datetime.fromtimestamp(int(source_timestamp))
 
         data = {}
-        data["second"] = self.dim_id_for_value("dim_time_second", datestamp.minute)
+        data["second"] = self.dim_id_for_value("dim_time_second", datestamp.second)
         data["minute"] = self.dim_id_for_value("dim_time_minute", datestamp.minute)
         data["hour"] = self.dim_id_for_value("dim_time_hour", datestamp.hour)
         data["day"] = self.dim_id_for_value("dim_date_day", datestamp.day)
@@ -389,8 +1539,65 @@ class OLAPDimensionSvc(object):
 
         return data
 
+    def get_dim_ids_for_timestamp(self, source_timestamp) -> dict:
+        if self.calendar:
+            return self.calendar.ids_for_timestamp(source_timestamp)
+
+        return self.dim_ids_from_datetime(source_timestamp)
+
+    def dim_ids_for_timestamps(self, timestamps) -> dict:
+        """Batch form of get_dim_ids_for_timestamp: maps an array of epoch timestamps
+        to a dict of dimension id arrays, keyed like get_dim_ids_for_timestamp's output.
+        """
+
+        if self.calendar:
+            return self.calendar.ids_for_timestamps(timestamps)
+
+        # without a calendar, decompose each distinct timestamp once
+        unique_timestamps, positions = np.unique(
+            np.asarray(timestamps, dtype=np.int64), return_inverse=True
+        )
+
+        fields = {
+            field: np.empty(len(unique_timestamps), dtype=np.int64)
+            for field, _ in self.TIME_DIMENSIONS
+        }
+
+        for i, timestamp in enumerate(unique_timestamps):
+            datestamp = datetime.datetime.fromtimestamp(int(timestamp))
+            for field, _ in self.TIME_DIMENSIONS:
+                fields[field][i] = getattr(datestamp, field)
+
+        return {
+            field: self.dimensions[tbl_name].ids_for_values(fields[field])[positions]
+            for field, tbl_name in self.TIME_DIMENSIONS
+        }
+
 
 class PGObjectLookupSvc(object):
+    """In-memory lookup table over one database table, keyed on <key_columns>.
+
+    Keys are tuples of the string forms of the key column values, so that find()
+    matches regardless of whether callers pass ints or strings. Init params:
+
+        columns           columns to hold for each row (default: all of them)
+        set_only          hold only the keys; find() returns True for a match
+        watermark_column  column holding each row's last-modified time (no default);
+                          refresh() then loads only rows changed since the last load.
+                          The column must be set on insert as well as on update.
+        refresh_interval  seconds after which find() calls refresh() on its own
+        lru_size          instead of preloading the table, query it on each miss
+                          and keep the last <lru_size> results (hits and misses)
+        bloom_filter      put a Bloom filter of every key in front of the lookup, so that
+                          most keys not in the table are rejected without a lookup
+                          (and, in LRU mode, without a query)
+        bloom_filter_file in LRU mode, where to persist the Bloom filter between runs (implies
+                          bloom_filter); it is reused only while the table's row count and a
+                          server-side hash of its key column values match. A preloaded
+                          table always builds its filter from the rows it loaded.
+        bloom_error_rate  the Bloom filter's target false-positive rate (default 0.01)
+    """
+
     def __init__(self, **kwargs):
         self.pg_svc = PostgreSQLService(**kwargs)
 
@@ -400,28 +1607,264 @@ class PGObjectLookupSvc(object):
         kwreader.read(**kwargs)  # TODO: possibly rename this to validate()
 
         self.table_name = kwargs["table_name"]
-        key_columns = kwargs["key_columns"]
-        self.lookup_tbl = dict()
+        self.key_columns = utils.to_list(kwargs["key_columns"])
+        self.set_only = utils.to_boolean(kwargs.get("set_only", False))
+        self.refresh_interval = float(kwargs.get("refresh_interval") or 0)
+        self.lru_size = int(kwargs.get("lru_size") or 0)
+
+        self.table = getattr(self.pg_svc.Base.classes, self.table_name).__table__
+
+        # incremental refresh is opt-in: a column which is only set on update
+        # (or not at all) would make refresh() miss rows
+        self.watermark_column = kwargs.get("watermark_column")
+        if self.watermark_column and self.watermark_column not in self.table.c:
+            raise Exception(f'watermark_column "{self.watermark_column}" is not a column of table {self.table_name}.')
+
+        projected_columns = utils.to_list(kwargs.get("columns"))
+        if self.set_only:
+            column_names = list(self.key_columns)
+        elif projected_columns:
+            column_names = self.key_columns + projected_columns
+        else:
+            column_names = list(self.table.c.keys())
+
+        if self.watermark_column:
+            column_names.append(self.watermark_column)
+
+        self.query = sqla.select(*[self.table.c[name] for name in dict.fromkeys(column_names)])
+        key_query_columns = self.key_columns + ([self.watermark_column] if self.watermark_column else [])
+        self.key_query = sqla.select(*[self.table.c[name] for name in dict.fromkeys(key_query_columns)])
+
+        self.lookup_tbl = set() if self.set_only else dict()
+        self.watermark = None
+        self.last_refresh = time.time()
 
-        with self.pg_svc.txn_scope() as session:
-            data_object = getattr(self.pg_svc.Base.classes, self.table_name)
-            resultset = session.query(data_object).all()
+        self.bloom_filter = None
+        self.bloom_filter_file = kwargs.get("bloom_filter_file")
+        self.bloom_error_rate = float(kwargs.get("bloom_error_rate") or 0.01)
+        self.stats = {"lookups": 0, "hits": 0, "misses": 0, "filter_rejects": 0, "false_positives": 0}
 
-            for record in resultset:
-                key = self.compose_key(record, *key_columns)
-                self.lookup_tbl[str(key)] = record
+        use_bloom_filter = utils.to_boolean(kwargs.get("bloom_filter", False)) or bool(self.bloom_filter_file)
+
+        # in LRU mode, read the table state before building the filter from it, so that
+        # the filter covers every row the state counts
+        table_state = self.table_state() if use_bloom_filter and self.lru_size else None
+
+        if self.lru_size:
+            self.fetch_cached = functools.lru_cache(maxsize=self.lru_size)(self.fetch)
+        else:
+            self.refresh()
+
+        if use_bloom_filter:
+            self.load_bloom_filter(table_state)
 
     def compose_key(self, record, *key_columns):
-        key_tokens = []
-        for kc in key_columns:
-            key_tokens.append(str(getattr(record, kc)))
+        return tuple(str(getattr(record, kc)) for kc in key_columns or self.key_columns)
+
+    def add(self, key, record):
+        if self.set_only:
+            self.lookup_tbl.add(key)
+        else:
+            self.lookup_tbl[key] = record
+
+    @staticmethod
+    def bloom_key(key):
+        return "\x1f".join(key)
+
+    def key_hash_aggregate(self):
+        """Aggregate hashing the key column values of every row: the sum of the first
+        64 bits of each row's md5, which does not depend on row order."""
+
+        key_text = sqla.func.concat_ws("\x1f", *[sqla.cast(self.table.c[kc], sqla.Text) for kc in self.key_columns])
+        row_hash = sqla.cast(
+            sqla.cast(sqla.func.concat("x", sqla.func.substr(sqla.func.md5(key_text), 1, 16)), BIT(64)),
+            sqla.BigInteger,
+        )
+        return sqla.func.coalesce(sqla.func.sum(row_hash), 0)
+
+    def table_state(self):
+        """Return the table's row count and highest watermark and, if the Bloom filter
+        is persisted, a hash of its keys, which identifies the version of the table a
+        saved filter was built from. The hash is computed by the server."""
+
+        aggregates = {"rows": sqla.func.count()}
+        if self.watermark_column:
+            aggregates["watermark"] = sqla.func.max(self.table.c[self.watermark_column])
+        if self.bloom_filter_file:
+            aggregates["key_hash"] = self.key_hash_aggregate()
+
+        query = sqla.select(*[aggregate.label(name) for name, aggregate in aggregates.items()]).select_from(self.table)
+        with self.pg_svc.connect() as connection:
+            record = connection.execute(query).one()._asdict()
+
+        return {
+            "rows": record["rows"],
+            "watermark": record.get("watermark"),
+            "key_hash": str(record["key_hash"]) if "key_hash" in record else None,
+        }
+
+    def bloom_filter_header(self, table_state):
+        return dict(table=self.table_name, key_columns=self.key_columns, **table_state)
+
+    def scan_keys(self):
+        with self.pg_svc.connect() as connection:
+            for record in connection.execution_options(stream_results=True, yield_per=10000).execute(self.key_query):
+                yield self.compose_key(record)
+
+    def build_bloom_filter(self, row_count, keys):
+        # leave headroom for the rows added by later refreshes
+        bloom_filter = utils.BloomFilter(max(row_count * 2, 1024), self.bloom_error_rate)
+        for key in keys:
+            bloom_filter.add(self.bloom_key(key))
+
+        return bloom_filter
+
+    def load_bloom_filter(self, table_state):
+        if not self.lru_size:
+            # the whole table is in memory, so the filter is built from exactly those keys
+            source = "lookup table"
+            bloom_filter = self.build_bloom_filter(len(self.lookup_tbl), self.lookup_tbl)
+
+        else:
+            source = "file"
+            bloom_filter = None
+            if self.bloom_filter_file:
+                bloom_filter = utils.BloomFilter.load(
+                    self.bloom_filter_file,
+                    error_rate=self.bloom_error_rate,
+                    **self.bloom_filter_header(table_state),
+                )
+
+            if bloom_filter is None:
+                source = "table"
+                bloom_filter = self.build_bloom_filter(table_state["rows"], self.scan_keys())
+
+                if self.bloom_filter_file:
+                    bloom_filter.save(self.bloom_filter_file, **self.bloom_filter_header(table_state))
+
+            if self.watermark is None:
+                self.watermark = table_state["watermark"]
+
+        self.bloom_filter = bloom_filter
+        mlog(
+            f"+++ Bloom filter for lookup table {self.table_name} loaded.",
+            source=source,
+            keys=bloom_filter.count,
+            bits=bloom_filter.num_bits,
+        )
+
+    def refresh(self):
+        """Bring the lookup table up to date: loads the rows changed since the last
+        refresh if we have a watermark, and reloads the whole table otherwise.
+        (Rows deleted from the table are only dropped by a full reload.)
+        In LRU mode this empties the cache, and only the keys of changed rows are
+        read, to be added to the Bloom filter (if any).
+        """
 
-        return "%".join(key_tokens)
+        self.last_refresh = time.time()
+
+        if self.lru_size:
+            self.fetch_cached.cache_clear()
+            if self.bloom_filter is None:
+                return
+
+        incremental = self.watermark is not None
+        query = self.key_query if self.lru_size else self.query
+        if incremental:
+            # >= rather than >: a row committed after our last load can carry the same
+            # timestamp as the watermark; re-adding the boundary rows is harmless
+            query = query.where(self.table.c[self.watermark_column] >= self.watermark)
+        elif not self.lru_size:
+            self.lookup_tbl = set() if self.set_only else dict()
+
+        table_state = None
+        if self.lru_size and self.bloom_filter_file:
+            table_state = self.table_state()
+
+        row_count = 0
+        with self.pg_svc.connect() as connection:
+            for record in connection.execution_options(stream_results=True, yield_per=10000).execute(query):
+                key = self.compose_key(record)
+                if not self.lru_size:
+                    self.add(key, record)
+                if self.bloom_filter is not None:
+                    self.bloom_filter.add(self.bloom_key(key))
+                row_count += 1
+
+                if self.watermark_column:
+                    row_watermark = getattr(record, self.watermark_column)
+                    if row_watermark is not None and (self.watermark is None or row_watermark > self.watermark):
+                        self.watermark = row_watermark
+
+        if table_state is not None:
+            self.bloom_filter.save(self.bloom_filter_file, **self.bloom_filter_header(table_state))
+
+        mlog(
+            f"+++ lookup table {self.table_name} {'refreshed' if incremental else 'loaded'}.",
+            rows=row_count,
+            size=len(self.lookup_tbl),
+        )
+
+    def fetch(self, key):
+        query = self.query.where(
+            *[self.table.c[kc] == value for kc, value in zip(self.key_columns, key)]
+        ).limit(1)
+
+        try:
+            with self.pg_svc.connect() as connection:
+                record = connection.execute(query).first()
+
+        except sqla.exc.DataError:
+            # a key which is not a valid value of its column's type (e.g. "abc" for
+            # an integer or uuid column) cannot match any row
+            return None
+
+        if record is None:
+            return None
+
+        return True if self.set_only else record
 
     def find(self, *values):
-        key = "%".join(values)
-        return self.lookup_tbl.get(key)
+        key = tuple(str(value) for value in values)
+
+        if self.refresh_interval and time.time() - self.last_refresh >= self.refresh_interval:
+            self.refresh()
+
+        self.stats["lookups"] += 1
+
+        if self.bloom_filter is not None and self.bloom_key(key) not in self.bloom_filter:
+            self.stats["filter_rejects"] += 1
+            self.stats["misses"] += 1
+            return None
+
+        if self.lru_size:
+            result = self.fetch_cached(key)
+        elif self.set_only:
+            result = True if key in self.lookup_tbl else None
+        else:
+            result = self.lookup_tbl.get(key)
+
+        if result is None:
+            self.stats["misses"] += 1
+            if self.bloom_filter is not None:
+                self.stats["false_positives"] += 1
+        else:
+            self.stats["hits"] += 1
+
+        return result
+
+    def lookup_stats(self):
+        return dict(self.stats)
 
     def update(self, record: object, *key_columns):
         key = self.compose_key(record, *key_columns)
-        self.lookup_tbl[str(key)] = record
+
+        if self.bloom_filter is not None:
+            self.bloom_filter.add(self.bloom_key(key))
+
+        if self.lru_size:
+            # the cache can't be seeded; drop it so the next find() sees the database
+            self.fetch_cached.cache_clear()
+            return
+
+        self.add(key, record)
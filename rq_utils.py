@@ -2,11 +2,24 @@
 
 
 from contextlib import ContextDecorator
+import asyncio
 import datetime
+import functools
+import hashlib
+import inspect
+import io
+import json
+import math
+import os
+import random
 import re
+import threading
+import time
 import urllib.parse
+import uuid
 
-from mercury.mlog import mlog, mlog_err
+from mercury.mlog import mlog
+from sqlalchemy import text
 
 
 
@@ -33,6 +46,19 @@ def to_boolean(raw_bool_value):
         raise Exception(f'unsupported boolean string "{raw_bool_value}"')
 
 
+def to_list(raw_list_value):
+    """Accept either a list or a comma-separated string (as passed from YAML
+    init params or the command line) and return a list of stripped strings."""
+
+    if not raw_list_value:
+        return []
+
+    if isinstance(raw_list_value, str):
+        return [token.strip() for token in raw_list_value.split(",") if token.strip()]
+
+    return [str(item).strip() for item in raw_list_value]
+
+
 def all_of(*args):
     expression = " and ".join([str(arg) for arg in args])
     return eval(expression)
@@ -55,6 +81,32 @@ def convert_to_timestamp(date_string: str):
     return datetime.timestamp(date_time)
 
 
+def hash_file(filename, algorithm="md5", chunk_size=8 * 1024 * 1024):
+    """Hash a file's contents in fixed-size chunks, so memory use stays flat."""
+
+    file_hash = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def s3_etag_for_file(filename, part_size, num_parts=1):
+    """Compute the ETag S3 would report for <filename> if it had been uploaded in
+    <num_parts> parts of <part_size> bytes (a plain MD5 for single-part uploads)."""
+
+    if num_parts <= 1:
+        return hash_file(filename, "md5")
+
+    part_digests = []
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(part_size), b""):
+            part_digests.append(hashlib.md5(chunk).digest())
+
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
 def sqla_record_to_dict(sqla_record, *fields):
     result = {}
     for f in fields:
@@ -63,6 +115,254 @@ def sqla_record_to_dict(sqla_record, *fields):
     return result
 
 
+class BloomFilter(object):
+    """Fixed-size Bloom filter over str (or bytes) keys, sized for <capacity> keys
+    at a false-positive rate of <error_rate>. A key that is not "in" the filter
+    was definitely never added; a key that is may or may not have been.
+
+    Filters can be saved to disk together with a header of caller-supplied values
+    (row counts, content hashes and so on); load() only accepts a saved filter if those
+    values still match, so a stale filter gets rebuilt rather than trusted.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = float(error_rate)
+        self.num_bits = max(int(math.ceil(-capacity * math.log(self.error_rate) / math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+
+        # derive all k bit positions from two 64-bit hashes (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def header(self, **values):
+        return dict(
+            values,
+            format_version=self.FORMAT_VERSION,
+            capacity=self.capacity,
+            error_rate=self.error_rate,
+            num_bits=self.num_bits,
+            num_hashes=self.num_hashes,
+            count=self.count,
+        )
+
+    def save(self, filename, **header_values):
+        """Write the filter to <filename> (atomically) as one JSON header line followed by the bit array."""
+
+        temp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(temp_filename, "wb") as f:
+            f.write(json.dumps(self.header(**header_values), default=str).encode("utf-8"))
+            f.write(b"\n")
+            f.write(self.bits)
+
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, **expected_values):
+        """Load a filter saved with save(). Returns None if there is no such file, or if
+        it is unreadable or any of <expected_values> differs from the saved header."""
+
+        try:
+            with open(filename, "rb") as f:
+                header = json.loads(f.readline())
+                bits = bytearray(f.read())
+
+        except (OSError, ValueError):
+            return None
+
+        # compare in serialized form, since that is how the header values were stored
+        expected_values = json.loads(json.dumps(expected_values, default=str))
+        if header.get("format_version") != cls.FORMAT_VERSION:
+            return None
+
+        for name, value in expected_values.items():
+            if header.get(name) != value:
+                return None
+
+        if len(bits) != (header["num_bits"] + 7) // 8:
+            return None
+
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.capacity = header["capacity"]
+        bloom_filter.error_rate = header["error_rate"]
+        bloom_filter.num_bits = header["num_bits"]
+        bloom_filter.num_hashes = header["num_hashes"]
+        bloom_filter.count = header["count"]
+        bloom_filter.bits = bits
+
+        return bloom_filter
+
+
+class RetryStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+        self.time_spent = 0.0
+        self.time_sleeping = 0.0
+
+    def record(self, **increments):
+        with self.lock:
+            for name, value in increments.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "failures": self.failures,
+                "time_spent": round(self.time_spent, 3),
+                "time_sleeping": round(self.time_sleeping, 3),
+            }
+
+
+class RetryPolicy(object):
+    """Retry with exponential backoff, jitter and an optional overall deadline.
+
+    The delay before retry N (counting from 0) is base_delay * multiplier**N, capped
+    at max_delay, with up to <jitter> of it (a fraction from 0 to 1) randomly
+    removed so that concurrent callers do not retry in lockstep. No retry is
+    scheduled if it would start after the deadline (in seconds from the first attempt).
+
+    exception_policies maps exception classes to the RetryPolicy used for them
+    (None means "do not retry"); the most specific class in the exception's MRO wins.
+    Exceptions not matching retry_on are never retried.
+
+    A policy can be used directly (call / call_async), as a decorator on plain
+    or async functions, or passed to retry_on_exception / retry_on_false_condition.
+    """
+
+    def __init__(self, **kwargs):
+        self.max_attempts = int(kwargs.get("max_attempts", 3))
+        self.base_delay = float(kwargs.get("base_delay", 0.5))
+        self.max_delay = float(kwargs.get("max_delay", 30.0))
+        self.multiplier = float(kwargs.get("multiplier", 2.0))
+        self.jitter = float(kwargs.get("jitter", 0.5))
+        self.deadline = float(kwargs["deadline"]) if kwargs.get("deadline") else None
+        self.retry_on = tuple(kwargs.get("retry_on", (Exception,)))
+        self.exception_policies = kwargs.get("exception_policies", {})
+        self.on_retry = kwargs.get("on_retry")  # called as on_retry(err, attempt, delay)
+        self.stats = RetryStats()
+
+    def policy_for(self, err):
+        if not isinstance(err, self.retry_on):
+            return None
+
+        for klass in err.__class__.__mro__:
+            if klass in self.exception_policies:
+                return self.exception_policies[klass]
+
+        return self
+
+    def backoff(self, retry_number):
+        delay = min(self.max_delay, self.base_delay * (self.multiplier**retry_number))
+        return delay * (1 - self.jitter * random.random())
+
+    def next_delay(self, err, retry_number, started_at):
+        """Return the number of seconds to wait before retry <retry_number>, or None
+        if <err> should not be retried."""
+
+        policy = self.policy_for(err) if err is not None else self
+        if policy is None or retry_number + 1 >= policy.max_attempts:
+            return None
+
+        delay = policy.backoff(retry_number)
+        if self.deadline is not None and time.time() - started_at + delay > self.deadline:
+            return None
+
+        if self.on_retry:
+            self.on_retry(err, retry_number + 1, delay)
+
+        self.stats.record(retries=1, time_sleeping=delay)
+        return delay
+
+    def call(self, function, *args, **kwargs):
+        started_at = time.time()
+        self.stats.record(calls=1)
+        retry_number = 0
+
+        try:
+            while True:
+                self.stats.record(attempts=1)
+                try:
+                    return function(*args, **kwargs)
+
+                except Exception as err:
+                    delay = self.next_delay(err, retry_number, started_at)
+                    if delay is None:
+                        self.stats.record(failures=1)
+                        raise
+
+                    time.sleep(delay)
+                    retry_number += 1
+        finally:
+            self.stats.record(time_spent=time.time() - started_at)
+
+    async def call_async(self, coroutine_function, *args, **kwargs):
+        started_at = time.time()
+        self.stats.record(calls=1)
+        retry_number = 0
+
+        try:
+            while True:
+                self.stats.record(attempts=1)
+                try:
+                    return await coroutine_function(*args, **kwargs)
+
+                except Exception as err:
+                    delay = self.next_delay(err, retry_number, started_at)
+                    if delay is None:
+                        self.stats.record(failures=1)
+                        raise
+
+                    await asyncio.sleep(delay)
+                    retry_number += 1
+        finally:
+            self.stats.record(time_spent=time.time() - started_at)
+
+    def __call__(self, function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                return await self.call_async(function, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.call(function, *args, **kwargs)
+
+        return wrapper
+
+
 class retry_on_exception(ContextDecorator):
     def __init__(self, target_exception_count, target_function, retry_hook, **kwargs):
         super().__init__()
@@ -71,6 +371,7 @@ class retry_on_exception(ContextDecorator):
         self.target_exception_count = target_exception_count
         self.num_retries = 0
         self.exception_class = kwargs.get("exception_class", Exception)
+        self.retry_policy = kwargs.get("retry_policy")  # optional RetryPolicy for backoff
         self.result = None
 
     def __enter__(self):
@@ -78,20 +379,27 @@ class retry_on_exception(ContextDecorator):
             "Entering retry context with target count %s and %s retries."
             % (self.target_exception_count, self.num_retries)
         )
+        started_at = time.time()
         while True:
             try:
                 mlog(">>> calling retry target...")
                 self.result = self.target_function()
                 break
             except self.exception_class as err:
-                if self.num_retries == self.target_exception_count:
+                delay = 0
+                if self.retry_policy and self.num_retries < self.target_exception_count:
+                    delay = self.retry_policy.next_delay(err, self.num_retries, started_at)
+
+                if self.num_retries == self.target_exception_count or delay is None:
                     mlog(
                         "Exiting retry context in FAIL mode with target count %s and %s retries."
                         % (self.target_exception_count, self.num_retries)
                     )
                     raise err
                 else:
-                    self.retry_hook()
+                    if self.retry_hook:
+                        self.retry_hook()
+                    time.sleep(delay)
                     self.num_retries += 1
 
         return self
@@ -105,12 +413,13 @@ class retry_on_exception(ContextDecorator):
 
 
 class retry_on_false_condition(ContextDecorator):
-    def __init__(self, target_fail_count, target_function, eval_function, retry_hook):
+    def __init__(self, target_fail_count, target_function, eval_function, retry_hook, **kwargs):
         super().__init__()
         self.target_function = target_function
         self.eval_function = eval_function  # must return a boolean
         self.retry_hook = retry_hook
         self.target_fail_count = target_fail_count
+        self.retry_policy = kwargs.get("retry_policy")  # optional RetryPolicy for backoff
         self.num_retries = 0
         self.result = None
 
@@ -118,6 +427,7 @@ class retry_on_false_condition(ContextDecorator):
         mlog(
             f"Entering retry context with target count {self.target_fail_count} and {self.num_retries} retries."
         )
+        started_at = time.time()
         while True:
             mlog(">>> calling retry target...")
             self.result = self.target_function()
@@ -125,13 +435,19 @@ class retry_on_false_condition(ContextDecorator):
                 break
 
             else:
-                if self.num_retries == self.target_fail_count:
+                delay = 0
+                if self.retry_policy and self.num_retries < self.target_fail_count:
+                    delay = self.retry_policy.next_delay(None, self.num_retries, started_at)
+
+                if self.num_retries == self.target_fail_count or delay is None:
                     mlog(
                         f"Exiting retry context in FAIL mode with target count {self.target_fail_count} and {self.num_retries} retries."
                     )
                     break
                 else:
-                    self.retry_hook()
+                    if self.retry_hook:
+                        self.retry_hook()
+                    time.sleep(delay)
                     self.num_retries += 1
 
         return self
@@ -160,6 +476,202 @@ def _make_sqla_values_clause(input_record: dict):
     return f"VALUES({value_string})"
 
 
+# PostgreSQL's wire protocol allows at most 65535 bind parameters per statement
+PG_MAX_BIND_PARAMS = 65535
+
+BULK_INSERT_FORMS = ["values", "unnest"]
+
+
+def quote_identifier(name: str):
+    """Double-quote a (possibly schema-qualified, dot-separated) SQL identifier."""
+
+    return ".".join('"' + part.replace('"', '""') + '"' for part in name.split("."))
+
+
+def make_onconflict_clause(conflict_columns=(), update_columns=()):
+    """Build an ON CONFLICT clause: DO UPDATE of <update_columns> from the incoming
+    (EXCLUDED) row, or DO NOTHING if there are none. Empty if no <conflict_columns>."""
+
+    if not conflict_columns:
+        return ""
+
+    target = ", ".join(quote_identifier(c) for c in conflict_columns)
+    if not update_columns:
+        return f"ON CONFLICT ({target}) DO NOTHING"
+
+    assignments = ", ".join(f"{quote_identifier(c)} = EXCLUDED.{quote_identifier(c)}" for c in update_columns)
+    return f"ON CONFLICT ({target}) DO UPDATE SET {assignments}"
+
+
+@functools.lru_cache(maxsize=256)
+def bulk_insert_parts(table_name: str,
+                      columns: tuple,
+                      conflict_columns: tuple = (),
+                      update_columns: tuple = (),
+                      form: str = "values",
+                      column_types: tuple = ()):
+    """Build the parts of a multi-row INSERT statement which do not depend on its row
+    count, as an (insert clause, row source, on-conflict clause) tuple. The row source
+    is None for form="values", whose VALUES list is built per statement.
+
+    These are cached by their arguments (which must all be hashable), so repeated
+    batches with the same column signature skip building them.
+    """
+
+    if form not in BULK_INSERT_FORMS:
+        raise Exception(f'Unsupported bulk insert form "{form}". Must be one of ({" | ".join(BULK_INSERT_FORMS)}).')
+
+    column_list = ", ".join(quote_identifier(c) for c in columns)
+    insert_clause = f"INSERT INTO {quote_identifier(table_name)} ({column_list})"
+
+    source_clause = None
+    if form == "unnest":
+        types = dict(column_types)
+        arrays = ", ".join(
+            f"CAST(:c{col} AS {types[name]}[])" if name in types else f":c{col}"
+            for col, name in enumerate(columns)
+        )
+        source_clause = f"SELECT * FROM unnest({arrays})"
+
+    return insert_clause, source_clause, make_onconflict_clause(conflict_columns, update_columns)
+
+
+def make_bulk_insert_statement(table_name: str,
+                               columns: tuple,
+                               row_count: int = 1,
+                               conflict_columns: tuple = (),
+                               update_columns: tuple = (),
+                               form: str = "values",
+                               column_types: tuple = ()):
+    """Build a multi-row INSERT statement with named bind parameters.
+
+    form="values" gives INSERT ... VALUES (:p0_0, :p0_1), (:p1_0, :p1_1) ... for
+    <row_count> rows, where :p<row>_<column> is the parameter for each value.
+
+    form="unnest" gives INSERT ... SELECT * FROM unnest(:c0, :c1 ...), taking one array
+    parameter per column, whatever the row count; <column_types> is a tuple of
+    (column, SQL type) pairs used to cast those arrays (needed for non-text columns).
+    """
+
+    insert_clause, source_clause, onconflict_clause = bulk_insert_parts(
+        table_name, columns, conflict_columns, update_columns, form, column_types
+    )
+
+    if source_clause is None:
+        source_clause = "VALUES " + ", ".join(
+            "(" + ", ".join(f":p{row}_{col}" for col in range(len(columns))) + ")" for row in range(row_count)
+        )
+
+    return f"{insert_clause} {source_clause} {onconflict_clause}".strip()
+
+
+@functools.lru_cache(maxsize=256)
+def _unnest_insert_clause(*args):
+    # an unnest statement is the same for any row count, so its parsed text() clause is cached too
+    return text(make_bulk_insert_statement(*args))
+
+
+def bulk_insert_params(records: list, columns, form: str = "values"):
+    if form == "values":
+        return {
+            f"p{row}_{col}": record.get(name) for row, record in enumerate(records) for col, name in enumerate(columns)
+        }
+
+    return {f"c{col}": [record.get(name) for record in records] for col, name in enumerate(columns)}
+
+
+def bulk_insert(connection,
+                table_name: str,
+                records: list,
+                columns=None,
+                conflict_columns=(),
+                update_columns=(),
+                form: str = "values",
+                column_types=None,
+                max_params: int = PG_MAX_BIND_PARAMS):
+    """INSERT a list of dict records through a SQLAlchemy connection, chunking the
+    batch so that no statement exceeds <max_params> bind parameters ("values" form)
+    or rows ("unnest" form). <columns> defaults to the keys of the first record.
+    Returns the number of rows inserted (or updated, when upserting).
+    """
+
+    if not records:
+        return 0
+
+    columns = tuple(columns or records[0].keys())
+    column_types = tuple(sorted((column_types or {}).items()))
+    chunk_size = max(max_params // len(columns), 1) if form == "values" else max_params
+
+    row_count = 0
+    for offset in range(0, len(records), chunk_size):
+        chunk = records[offset:offset + chunk_size]
+        if form == "values":
+            statement = text(make_bulk_insert_statement(
+                table_name, columns, len(chunk), tuple(conflict_columns), tuple(update_columns), form, column_types
+            ))
+        else:
+            statement = _unnest_insert_clause(
+                table_name, columns, 1, tuple(conflict_columns), tuple(update_columns), form, column_types
+            )
+        result = connection.execute(statement, bulk_insert_params(chunk, columns, form))
+        row_count += result.rowcount
+
+    return row_count
+
+
+def _copy_csv_value(value):
+    # in COPY's CSV format, an unquoted empty field is NULL and a quoted one is ''
+    if value is None:
+        return ""
+
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def copy_records(connection, table_name: str, records: list, columns=None, conflict_columns=(), update_columns=()):
+    """Load a list of dict records with COPY ... FROM STDIN, inside the transaction of
+    the given SQLAlchemy connection. With <conflict_columns>, the records are copied
+    into a temporary staging table and then upserted from there (COPY itself has no
+    ON CONFLICT). Returns the number of rows loaded.
+    """
+
+    if not records:
+        return 0
+
+    columns = tuple(columns or records[0].keys())
+    column_list = ", ".join(quote_identifier(c) for c in columns)
+
+    buffer = io.StringIO()
+    for record in records:
+        buffer.write(",".join(_copy_csv_value(record.get(name)) for name in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        if not conflict_columns:
+            cursor.copy_expert(f"COPY {quote_identifier(table_name)} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+            return cursor.rowcount
+
+        staging_table = quote_identifier(f"copy_staging_{uuid.uuid4().hex}")
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {staging_table} (LIKE {quote_identifier(table_name)} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        cursor.copy_expert(f"COPY {staging_table} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(
+            f"INSERT INTO {quote_identifier(table_name)} ({column_list}) SELECT {column_list} FROM {staging_table} "
+            + make_onconflict_clause(conflict_columns, update_columns)
+        )
+        row_count = cursor.rowcount
+        cursor.execute(f"DROP TABLE {staging_table}")
+        return row_count
+
+    finally:
+        cursor.close()
+
+
 def filepath_to_s3uri(pathname):
     if "s3/" in pathname:
         # non-greedy .*? in pattern in case there's an 's3/' later
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    bench_dim_lookup.py --config <configfile> --service <service_name> [--samples=<n>] [--seed=<n>]
+
+'''
+
+'''
+Check and time the OLAP timestamp -> dimension id lookups of the OLAPDimensionSvc
+registered as <service_name> in <configfile>.
+
+Random timestamps spanning the calendar's full date range (plus every UTC offset
+transition, and the seconds either side of each) are looked up three ways:
+
+    reference   datetime decomposition + one lookup per dimension (dim_ids_from_datetime)
+    calendar    the precomputed calendar, one timestamp per call (get_dim_ids_for_timestamp)
+    batch       the numpy batch path, one call for all timestamps (dim_ids_for_timestamps)
+
+Any disagreement with the reference path is reported and the script exits non-zero.
+Timings are emitted as a single JSON record.
+'''
+
+import os, sys
+import time
+import docopt
+import numpy as np
+from snap import snap, common
+from mercury.mlog import mlog, mlog_err
+import script_utils  # puts the repo root on sys.path, for the rq_* imports
+import rq_codec as codec
+
+
+def sample_timestamps(calendar, sample_count, seed):
+    # stay a day clear of either end, so that no UTC offset can shift a sample
+    # outside the calendar's (local) date range
+    first_ts = (calendar.first_day + 1) * calendar.SECONDS_PER_DAY
+    last_ts = calendar.last_day * calendar.SECONDS_PER_DAY
+
+    rng = np.random.default_rng(seed)
+    timestamps = rng.integers(first_ts, last_ts, size=sample_count, dtype=np.int64)
+
+    # make sure the edges of every offset transition are exercised
+    edges = [
+        ts + delta for ts in calendar.transitions[1:] for delta in (-1, 0, 1)
+        if first_ts <= ts + delta < last_ts
+    ]
+    return np.concatenate([timestamps, np.array(edges, dtype=np.int64)])
+
+
+def time_call(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+def main(args):
+
+    yaml_config = common.read_config_file(args['<configfile>'])
+    service_registry = common.ServiceObjectRegistry(snap.initialize_services(yaml_config))
+    dim_svc = service_registry.lookup(args['<service_name>'])
+
+    if dim_svc.calendar is None:
+        mlog_err(Exception('No calendar was built; all of the time dimension tables must be loaded.'),
+                 issue='Cannot benchmark the calendar lookup.')
+        return 1
+
+    timestamps = sample_timestamps(dim_svc.calendar, int(args['--samples'] or 100000), int(args['--seed'] or 0))
+    timestamp_list = timestamps.tolist()
+
+    reference, reference_time = time_call(lambda: [dim_svc.dim_ids_from_datetime(ts) for ts in timestamp_list])
+    per_call, per_call_time = time_call(lambda: [dim_svc.get_dim_ids_for_timestamp(ts) for ts in timestamp_list])
+    batch, batch_time = time_call(dim_svc.dim_ids_for_timestamps, timestamps)
+
+    mismatches = 0
+    for i, expected in enumerate(reference):
+        batch_ids = {field: int(batch[field][i]) for field in expected}
+        if per_call[i] != expected or batch_ids != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                mlog('!!! dimension id mismatch.', timestamp=timestamp_list[i],
+                     reference=expected, calendar=per_call[i], batch=batch_ids)
+
+    print(codec.dumps({
+        'timestamps': len(timestamp_list),
+        'offset_transitions': len(dim_svc.calendar.transitions) - 1,
+        'mismatches': mismatches,
+        'reference_sec': round(reference_time, 4),
+        'calendar_sec': round(per_call_time, 4),
+        'batch_sec': round(batch_time, 4),
+        'calendar_speedup': round(reference_time / per_call_time, 1),
+        'batch_speedup': round(reference_time / batch_time, 1),
+    }))
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
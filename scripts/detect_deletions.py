@@ -8,9 +8,10 @@ Usage:
 
 
 import os, sys
-import json
 import docopt
 from mercury.mlog import mlog
+import script_utils  # puts the repo root on sys.path, for the rq_* imports
+import rq_codec as codec
 
 
 def main(args):
@@ -33,7 +34,7 @@ def main(args):
             if not line:
                 continue
 
-            record = json.loads(line)
+            record = codec.loads(line)
             manifest_files.add(record['local_file'])
 
 
@@ -2,53 +2,189 @@
 
 '''
 Usage:
-    dfscan.py --listfile <datafile> [--stats=<column:stat>...]
+    dfscan.py --listfile <datafile> [--stats=<column:stat>...] [--chunksize=<n>]
     dfscan.py <datafile> [--stats=<column:stat>...]
 
 '''
 
+'''
+Print a data file (a JSON array, or JSONL with --listfile) as a table, or with
+--stats, compute the given column statistics and print them as one JSON record
+of {"<column> <stat>": value} pairs (null where a stat is undefined, e.g. the
+mean of an empty column); for example:
+
+    dfscan.py data/pop_data_nation.json --stats=Population:std,Population:mean
+
+Supported stats: count, sum, mean, std, var, min, max, median (std and var use
+ddof=1, as pandas does). All of them are computed in a single aggregation pass.
+
+With --chunksize, a JSONL file is read <n> records at a time and the stats are
+accumulated chunk by chunk, so memory use stays constant however large the file
+is; median is not available in this mode.
+'''
 
 import os, sys
-import json
+import math
 import docopt
 import pandas as pd
 from mercury.utils import parse_cli_params
+import script_utils  # puts the repo root on sys.path, for the rq_* imports
+import rq_codec as codec
+
+
+SUPPORTED_STATS = ['count', 'sum', 'mean', 'std', 'var', 'min', 'max', 'median']
+STREAMING_STATS = ['count', 'sum', 'mean', 'std', 'var', 'min', 'max']
+
+
+def parse_stats(stat_params, supported_stats=SUPPORTED_STATS):
+    '''Parse --stats values ("column:stat" pairs, comma-separated) into a list of (column, stat) tuples.'''
+
+    stat_specs = []
+    for param in stat_params:
+        for item in param.split(','):
+            column, _, stat = item.strip().rpartition(':')
+            if not column or stat not in supported_stats:
+                raise Exception(
+                    f'Invalid stat "{item}". Must be <column>:<stat>, with stat one of ({" | ".join(supported_stats)}).'
+                )
+            stat_specs.append((column, stat))
+
+    return stat_specs
+
+
+def to_json_value(value):
+    # numpy scalars (numpy.int64 in particular) are not JSON serializable
+    value = value.item() if hasattr(value, 'item') else value
+
+    # NaN is not valid JSON; emit null, as orjson would, whichever codec is in use
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def compute_stats(df, stat_specs):
+    '''Compute every requested stat in one DataFrame.agg() pass.'''
+
+    stats_by_column = {}
+    for column, stat in stat_specs:
+        stats_by_column.setdefault(column, [])
+        if stat not in stats_by_column[column]:
+            stats_by_column[column].append(stat)
+
+    results = df.agg(stats_by_column)
+
+    output_data = {}
+    for column, stat in stat_specs:
+        value = to_json_value(results.at[stat, column])
+
+        # agg() upcasts a column's results to a common dtype; give integer stats back as ints
+        integer_stat = stat == 'count' or (stat in ('sum', 'min', 'max') and pd.api.types.is_integer_dtype(df[column]))
+        if integer_stat and isinstance(value, float):
+            value = int(value)
+
+        output_data[f'{column} {stat}'] = value
+
+    return output_data
+
+
+class RunningStats(object):
+    '''Mergeable accumulator for count, sum, mean, variance (as M2, the sum of squared
+    deviations from the mean), min and max over one column. Each chunk is summarized
+    with vectorized pandas calls, and merged in with Chan et al.'s parallel update.
+    '''
+
+    def __init__(self, moments=True):
+        self.moments = moments
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def update(self, series):
+        series = series.dropna()
+        chunk_count = len(series)
+        if not chunk_count:
+            return
+
+        chunk_min = series.min()
+        chunk_max = series.max()
+        self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+        self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+
+        if self.moments:
+            chunk_mean = series.mean()
+            chunk_m2 = ((series - chunk_mean) ** 2).sum()
+            self.total += series.sum()
+
+            combined_count = self.count + chunk_count
+            delta = chunk_mean - self.mean
+            self.mean += delta * chunk_count / combined_count
+            self.m2 += chunk_m2 + delta ** 2 * self.count * chunk_count / combined_count
+
+        self.count += chunk_count
+
+    def value(self, stat):
+        if stat == 'count':
+            return self.count
+
+        if stat == 'sum':
+            return self.total
+
+        if stat in ('min', 'max'):
+            value = getattr(self, stat)
+            return math.nan if value is None else value
+
+        if stat == 'mean':
+            return self.mean if self.count else math.nan
+
+        variance = self.m2 / (self.count - 1) if self.count > 1 else math.nan
+        return math.sqrt(variance) if stat == 'std' else variance
+
+
+def compute_stats_chunked(chunks, stat_specs):
+    '''Accumulate the requested stats over an iterable of DataFrame chunks.'''
+
+    accumulators = {}
+    for column, stat in stat_specs:
+        accumulator = accumulators.setdefault(column, RunningStats(moments=False))
+        if stat not in ('count', 'min', 'max'):
+            accumulator.moments = True
+
+    for chunk in chunks:
+        for column, accumulator in accumulators.items():
+            accumulator.update(chunk[column])
+
+    return {f'{column} {stat}': to_json_value(accumulators[column].value(stat)) for column, stat in stat_specs}
 
 
 def main(args):
 
+    if args['--chunksize']:
+        if not args['--stats']:
+            raise Exception('--chunksize requires --stats.')
+
+        stat_specs = parse_stats(args['--stats'], STREAMING_STATS)
+        chunks = pd.read_json(args['<datafile>'], lines=True, chunksize=int(args['--chunksize']))
+        with chunks:
+            print(codec.dumps(compute_stats_chunked(chunks, stat_specs)))
+        return
+
     if args['--listfile']:
         df = pd.read_json(args['<datafile>'], lines=True)
 
     else:
         df = pd.read_json(args['<datafile>'])
-    
-    if args['--stats']:
 
-        raw_param_str = args['--stats']         
-
-        
-        stat_list = raw_param_str[0].split(',')
-
-        output_data = dict()
-
-        for item in stat_list:
-            tokens = item.split(':')
-            column = tokens[0]
-            stat = tokens[1]
-
-            command = f"df['{column}'].{stat}()"  # df['age'].std()
-            
-            key = f'{column} {stat}'
-            output_data[key] = eval(command)
-            
-        print(json.dumps(output_data))
+    if args['--stats']:
+        print(codec.dumps(compute_stats(df, parse_stats(args['--stats']))))
 
     else:
         print(df.to_string())
-    
+
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
-    main(args)
\ No newline at end of file
+    main(args)
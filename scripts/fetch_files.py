@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    fetch_files.py --manifest <manifest_file> --dir <download_dir> [--workers=<n>] [--attempts=<n>] [--user-agent=<ua>] [--timeout=<secs>]
+
+'''
+
+'''
+Download every file in a manifest (one JSON record per line, with base_url, srcfile
+and local_file fields) into <download_dir>, using --workers (default 8) concurrent
+downloads.
+
+- A file is downloaded to <local_file>.part and renamed into place when complete.
+  The validator of the response it came from (its strong ETag, or failing that
+  its Last-Modified date) is saved in <local_file>.part.validator as soon as the
+  download starts. If a .part file is left over from an interrupted run, we resume
+  it with a Range request guarded by If-Range on that validator, so a changed file
+  is downloaded from scratch; a .part file with no validator is discarded.
+
+- If the file already exists locally, we send If-None-Match (using the ETag saved
+  in <local_file>.etag) and If-Modified-Since (using the file's mtime, which we set
+  to the server's Last-Modified), so an unchanged file comes back as a 304.
+
+Each manifest record is emitted, in manifest order, with the added fields
+download_status (downloaded | not_modified | failed), http_status, bytes
+and duration; filter out the failed records and the output can be fed to ngst.
+'''
+
+import os, sys
+import time
+import asyncio
+import email.utils
+import docopt
+import aiohttp
+from mercury.mlog import mlog
+from script_utils import DEFAULT_USER_AGENT, read_manifest
+import rq_utils as utils
+import rq_codec as codec
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# client errors which are worth retrying (request timeout, rate limited)
+RETRYABLE_STATUSES = [408, 429]
+
+
+class PermanentDownloadError(Exception):
+    def __init__(self, status, url):
+        Exception.__init__(self, f'HTTP status {status} for {url}')
+        self.status = status
+
+
+class DownloadTarget(object):
+    def __init__(self, download_dir, record):
+        self.url = f"{record['base_url']}{record['srcfile']}"
+        self.path = os.path.join(download_dir, record['local_file'])
+        self.partial_path = f'{self.path}.part'
+        self.etag_path = f'{self.path}.etag'
+        self.validator_path = f'{self.partial_path}.validator'
+
+    def read_sidecar(self, path):
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                return f.read().strip() or None
+        return None
+
+    def saved_etag(self):
+        return self.read_sidecar(self.etag_path)
+
+    def discard_partial(self):
+        for path in [self.partial_path, self.validator_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def request_headers(self):
+        headers = {}
+        etag = self.saved_etag()
+
+        if os.path.isfile(self.partial_path) and os.path.getsize(self.partial_path) > 0:
+            validator = self.read_sidecar(self.validator_path)
+            if validator:
+                headers['Range'] = f'bytes={os.path.getsize(self.partial_path)}-'
+                headers['If-Range'] = validator
+            else:
+                # without a validator we cannot tell whether the partial file still
+                # matches the resource, so download it again from the start
+                self.discard_partial()
+
+        if 'Range' not in headers and os.path.isfile(self.path):
+            if etag:
+                headers['If-None-Match'] = etag
+            headers['If-Modified-Since'] = email.utils.formatdate(os.path.getmtime(self.path), usegmt=True)
+
+        return headers
+
+    def start(self, response):
+        '''Save the validator of a full (200) response before its body is written, so
+        that an interrupted download can be resumed against the same version.'''
+
+        validator = response.headers.get('ETag')
+        if not validator or validator.startswith('W/'):
+            # If-Range requires a strong validator; fall back to the modification date
+            validator = response.headers.get('Last-Modified')
+
+        if validator:
+            with open(self.validator_path, 'w') as f:
+                f.write(validator)
+        elif os.path.isfile(self.validator_path):
+            os.remove(self.validator_path)
+
+    def complete(self, response):
+        os.replace(self.partial_path, self.path)
+        if os.path.isfile(self.validator_path):
+            os.remove(self.validator_path)
+
+        last_modified = response.headers.get('Last-Modified')
+        if last_modified:
+            mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+            os.utime(self.path, (mtime, mtime))
+
+        etag = response.headers.get('ETag')
+        if etag:
+            with open(self.etag_path, 'w') as f:
+                f.write(etag)
+        elif os.path.isfile(self.etag_path):
+            os.remove(self.etag_path)
+
+
+async def download(session, target):
+    '''Make one download attempt; returns (download_status, http_status, bytes_received).'''
+
+    request_headers = target.request_headers()
+
+    async with session.get(target.url, headers=request_headers) as response:
+        if response.status == 304:
+            return ('not_modified', response.status, 0)
+
+        if response.status == 416 and 'Range' in request_headers:
+            # our partial file is no longer valid for this resource; start over
+            target.discard_partial()
+            raise Exception('Range not satisfiable; restarting download.')
+
+        if 400 <= response.status < 500 and response.status not in RETRYABLE_STATUSES:
+            raise PermanentDownloadError(response.status, target.url)
+
+        response.raise_for_status()
+
+        # a 200 in reply to a Range request means the server sent the whole file
+        file_mode = 'ab' if response.status == 206 else 'wb'
+        if response.status != 206:
+            target.start(response)
+
+        bytes_received = 0
+        with open(target.partial_path, file_mode) as f:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                f.write(chunk)
+                bytes_received += len(chunk)
+
+        target.complete(response)
+        return ('downloaded', response.status, bytes_received)
+
+
+async def fetch_file(session, semaphore, retry_policy, download_dir, record):
+
+    target = DownloadTarget(download_dir, record)
+    output_record = dict(record)
+
+    async with semaphore:
+        start_time = time.time()
+        try:
+            status, http_status, bytes_received = await retry_policy.call_async(download, session, target)
+
+        except Exception as err:
+            mlog(f'!!! download failed: {err.__class__.__name__}: {err}', url=target.url)
+            status, http_status, bytes_received = ('failed', getattr(err, 'status', None), 0)
+
+        output_record.update({
+            'download_status': status,
+            'http_status': http_status,
+            'bytes': bytes_received,
+            'duration': round(time.time() - start_time, 3)
+        })
+
+    return output_record
+
+
+async def fetch_files(records, download_dir, **kwargs):
+    '''Yield the download result for each manifest record, in manifest order.'''
+
+    workers = int(kwargs.get('workers') or 8)
+    retry_policy = utils.RetryPolicy(
+        max_attempts=kwargs.get('attempts') or 3,
+        base_delay=1.0,
+        exception_policies={PermanentDownloadError: None}
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=float(kwargs.get('timeout') or 60))
+    headers = {'User-Agent': kwargs.get('user_agent') or DEFAULT_USER_AGENT}
+
+    semaphore = asyncio.Semaphore(workers)
+    connector = aiohttp.TCPConnector(limit=workers)
+
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+        tasks = [
+            asyncio.create_task(fetch_file(session, semaphore, retry_policy, download_dir, rec))
+            for rec in records
+        ]
+
+        for task in tasks:
+            yield await task
+
+
+async def run(args):
+
+    records = read_manifest(args['<manifest_file>'])
+
+    async for output_record in fetch_files(records,
+                                           args['<download_dir>'],
+                                           workers=args['--workers'],
+                                           attempts=args['--attempts'],
+                                           user_agent=args['--user-agent'],
+                                           timeout=args['--timeout']):
+        print(codec.dumps(output_record))
+
+
+def main(args):
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
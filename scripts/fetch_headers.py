@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    fetch_headers.py --manifest <manifest_file> --fields=<field>... [--concurrency=<n>] [--per-host=<n>] [--rate=<rps>] [--user-agent=<ua>] [--timeout=<secs>]
+
+'''
+
+'''
+Issue an HTTP HEAD request for every file in a download manifest (one JSON record
+per line, with base_url and srcfile fields) and emit the selected header fields
+as one JSON record per line, in manifest order.
+
+Requests run concurrently (--concurrency, default 16), with at most --per-host
+(default 4) open connections and --rate (default: unlimited) requests per second
+to any one host. Connections are kept alive and reused between requests.
+
+Each output record also carries a fetch_error field: null if the request succeeded,
+otherwise a description of the failure (the HTTP status, or the exception raised),
+in which case the header fields are all null. Failed records are still emitted, so
+that the output stays line-aligned with the manifest.
+'''
+
+import os, sys
+import time
+import asyncio
+import docopt
+import aiohttp
+from urllib.parse import urlsplit
+from mercury.mlog import mlog
+from script_utils import DEFAULT_USER_AGENT, read_manifest
+import rq_codec as codec
+
+
+class HostRateLimiter(object):
+    def __init__(self, requests_per_second=None):
+        self.min_interval = 1.0 / requests_per_second if requests_per_second else 0
+        self.locks = {}
+        self.next_request_time = {}
+
+    async def wait(self, host):
+        if not self.min_interval:
+            return
+
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            wait_time = self.next_request_time.get(host, now) - now
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+
+            self.next_request_time[host] = max(now, self.next_request_time.get(host, now)) + self.min_interval
+
+
+async def fetch_header_fields(session, semaphore, rate_limiter, record, fields):
+
+    url = f"{record['base_url']}{record['srcfile']}"
+    output_record = {field: None for field in fields}
+    output_record['fetch_error'] = None
+
+    async with semaphore:
+        await rate_limiter.wait(urlsplit(url).netloc)
+        try:
+            async with session.head(url, allow_redirects=True) as response:
+                if response.status >= 400:
+                    mlog(f'!!! HEAD request failed with status {response.status}', url=url)
+                    output_record['fetch_error'] = f'HTTP status {response.status}'
+                    return output_record
+
+                for field in fields:
+                    output_record[field] = response.headers.get(field)
+
+        except Exception as err:
+            mlog(f'!!! HEAD request failed: {err.__class__.__name__}: {err}', url=url)
+            output_record['fetch_error'] = f'{err.__class__.__name__}: {err}'
+
+    return output_record
+
+
+async def fetch_headers(records, fields, **kwargs):
+    '''Yield the header-field record for each manifest record, in manifest order.'''
+
+    concurrency = int(kwargs.get('concurrency') or 16)
+    per_host = int(kwargs.get('per_host') or 4)
+    rate_limiter = HostRateLimiter(float(kwargs['rate']) if kwargs.get('rate') else None)
+    timeout = aiohttp.ClientTimeout(total=float(kwargs.get('timeout') or 60))
+    headers = {'User-Agent': kwargs.get('user_agent') or DEFAULT_USER_AGENT}
+
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+        tasks = [
+            asyncio.create_task(fetch_header_fields(session, semaphore, rate_limiter, rec, fields))
+            for rec in records
+        ]
+
+        for task in tasks:
+            yield await task
+
+
+async def run(args):
+
+    records = read_manifest(args['<manifest_file>'])
+    field_list = args['--fields'][0].split(',')
+
+    async for output_record in fetch_headers(records,
+                                             field_list,
+                                             concurrency=args['--concurrency'],
+                                             per_host=args['--per-host'],
+                                             rate=args['--rate'],
+                                             user_agent=args['--user-agent'],
+                                             timeout=args['--timeout']):
+        print(codec.dumps(output_record))
+
+
+def main(args):
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
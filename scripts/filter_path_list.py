@@ -15,7 +15,6 @@ we get at least one "directory" type entry with no trailing filename.
 '''
 
 import os, sys
-import json
 import docopt
 from mercury.utils import read_stdin
 
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    gen_metahashes.py --manifest <manifest_file> --headers <header_fields_file> --fields=<field>... [--hash=<algorithm>]
+    gen_metahashes.py --manifest <manifest_file> --hdr-dir <header_dir> --fields=<field>... [--hash=<algorithm>]
+
+'''
+
+'''
+Compute the metahash for every file in a download manifest and emit each manifest
+record, with its "metahash" field added, as one JSON record per line.
+
+The header fields come either from a JSONL file line-aligned with the manifest
+(as written by fetch_headers.py), or from the raw HTTP header file named in each
+record's header_file field, under <header_dir>.
+
+The hash is taken over a canonical form of the selected fields: one
+"<field>:<value>" line per field, with field names lowercased and sorted and
+values stripped of surrounding whitespace (a missing field has an empty value).
+--hash may be md5 (the default), sha256, or xxhash (requires the xxhash package).
+
+A record whose headers could not be fetched (a non-null fetch_error in its header
+fields) gets a null metahash and carries the fetch_error along: hashing its empty
+fields would give every failed file the same, real-looking metahash. Such records
+are skipped by manifest_diff.py, the manifest filters and the ingest datastores.
+'''
+
+import os, sys
+import hashlib
+import docopt
+from script_utils import read_jsonl
+from parse_header import hdr_to_dict
+import rq_codec as codec
+
+
+def make_hasher(algorithm):
+    if algorithm == 'xxhash':
+        try:
+            import xxhash
+        except ImportError:
+            raise Exception('The xxhash algorithm requires the "xxhash" package to be installed.')
+        return xxhash.xxh64
+
+    if algorithm not in ('md5', 'sha256'):
+        raise Exception(f'Unsupported hash algorithm "{algorithm}". Must be one of (md5 | sha256 | xxhash).')
+
+    return getattr(hashlib, algorithm)
+
+
+def canonical_header_string(header_fields: dict, fields: list) -> str:
+    normalized = {str(key).lower(): value for key, value in header_fields.items()}
+
+    lines = []
+    for field in sorted(f.lower() for f in fields):
+        value = normalized.get(field)
+        lines.append(f"{field}:{'' if value is None else str(value).strip()}")
+
+    return '\n'.join(lines)
+
+
+def compute_metahash(header_fields: dict, fields: list, hasher=hashlib.md5) -> str:
+    return hasher(canonical_header_string(header_fields, fields).encode('utf-8')).hexdigest()
+
+
+def header_fields_from_hdr_files(manifest_records, header_dir):
+    for record in manifest_records:
+        with open(os.path.join(header_dir, record['header_file']), 'r') as f:
+            yield hdr_to_dict(f.read())
+
+
+def main(args):
+
+    field_list = args['--fields'][0].split(',')
+    hasher = make_hasher(args['--hash'] or 'md5')
+
+    manifest_records = list(read_jsonl(args['<manifest_file>']))
+
+    if args['--headers']:
+        header_records = list(read_jsonl(args['<header_fields_file>']))
+        if len(header_records) != len(manifest_records):
+            raise Exception(
+                f'Header file has {len(header_records)} records but the manifest has {len(manifest_records)}.'
+            )
+    else:
+        header_records = header_fields_from_hdr_files(manifest_records, args['<header_dir>'])
+
+    for record, header_fields in zip(manifest_records, header_records):
+        if header_fields.get('fetch_error'):
+            record['metahash'] = None
+            record['fetch_error'] = header_fields['fetch_error']
+        else:
+            record['metahash'] = compute_metahash(header_fields, field_list, hasher)
+        print(codec.dumps(record))
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
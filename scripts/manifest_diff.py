@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    manifest_diff.py --config <configfile> --manifest <manifest_file> --outdir <output_dir>
+    manifest_diff.py --dbassets <asset_file> --manifest <manifest_file> --outdir <output_dir>
+
+'''
+
+'''
+Compare a file ingest manifest against the live (non-deleted) file assets in our
+database, in a single pass over the manifest, and sort its records into:
+
+    manifest_added.jsonl      files we have no record of
+    manifest_changed.jsonl    files we have, but whose metahash has changed
+    manifest_unchanged.jsonl  files whose filename and metahash we already have
+    manifest_deleted.jsonl    live assets missing from the manifest,
+                              as {"deleted_filename": ...} records
+
+in <output_dir>. Records with no metahash (their headers could not be fetched) are
+counted as "unhashed" and left out of every stream; their files are not treated as
+deleted. The asset state is read either directly from the database (using
+the "postgres" service in <configfile>) or from a JSONL export of file_assets.
+
+Only the asset index (filename -> metahashes) is held in memory; the manifest is streamed.
+'''
+
+import os, sys
+import docopt
+from snap import snap, common
+from mercury.mlog import mlog
+from script_utils import read_jsonl
+from rq_filters import FileAssetIndex
+import rq_codec as codec
+
+
+DIFF_STREAMS = ['added', 'changed', 'unchanged', 'deleted']
+
+
+def load_index_from_export(asset_file):
+    asset_index = FileAssetIndex()
+    for record in read_jsonl(asset_file):
+        if record.get('deleted_ts') is None:
+            asset_index.add(record['filename'], record['source_metahash'])
+
+    return asset_index
+
+
+def diff_manifest(manifest_records, asset_index, writers):
+    '''Route each manifest record to the added, changed or unchanged writer, then
+    emit a deletion record for every indexed filename the manifest did not mention.
+    Returns the number of records written to each stream.
+    '''
+
+    counts = {stream: 0 for stream in DIFF_STREAMS}
+    counts['unhashed'] = 0
+    seen_filenames = set()
+
+    for record in manifest_records:
+        filename = record['local_file']
+        known_hashes = asset_index.hashes_for(filename)
+
+        if known_hashes:
+            seen_filenames.add(filename)
+
+        if record.get('metahash') is None:
+            counts['unhashed'] += 1
+            continue
+
+        matching_records = known_hashes.count(record['metahash'])
+        if matching_records > 1:
+            raise Exception('+++++++ FATAL DATABASE INCONSISTENCY: duplicate hashes found')
+
+        if matching_records == 1:
+            stream = 'unchanged'
+        elif known_hashes:
+            stream = 'changed'
+        else:
+            stream = 'added'
+
+        writers[stream](record)
+        counts[stream] += 1
+
+    for filename in asset_index.hashes_by_filename:
+        if filename not in seen_filenames:
+            mlog(f'file deletion detected: {filename}')
+            writers['deleted']({'deleted_filename': filename})
+            counts['deleted'] += 1
+
+    return counts
+
+
+def main(args):
+
+    if args['--config']:
+        yaml_config = common.read_config_file(args['<configfile>'])
+        service_registry = common.ServiceObjectRegistry(snap.initialize_services(yaml_config))
+        asset_index = FileAssetIndex.from_db(service_registry.lookup('postgres'))
+    else:
+        asset_index = load_index_from_export(args['<asset_file>'])
+
+    output_dir = args['<output_dir>']
+    output_files = {
+        stream: open(os.path.join(output_dir, f'manifest_{stream}.jsonl'), 'w') for stream in DIFF_STREAMS
+    }
+
+    writers = {
+        stream: (lambda record, f=f: f.write(codec.dumps(record) + '\n')) for stream, f in output_files.items()
+    }
+
+    try:
+        counts = diff_manifest(read_jsonl(args['<manifest_file>']), asset_index, writers)
+    finally:
+        for f in output_files.values():
+            f.close()
+
+    mlog('+++ manifest diff complete.', **counts)
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
@@ -11,10 +11,11 @@ Usage:
 
 import os, sys
 import re
-import json
 import docopt
 from mercury.utils import read_stdin
 from mercury.utils import parse_cli_params
+import script_utils  # puts the repo root on sys.path, for the rq_* imports
+import rq_codec as codec
 
 
 HEADER_ENTRY_RX = re.compile(r'^[a-zA-Z0-9\-]+:')
@@ -66,7 +67,7 @@ def main(args):
         extra_fields = parse_cli_params(args['--params'])
         output_record.update(extra_fields)
 
-    print(json.dumps(output_record))
+    print(codec.dumps(output_record))
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
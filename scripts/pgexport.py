@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    pgexport.py --config <configfile> --table <table_name> [--columns=<column>...] [--where-null=<column>...] [--fetch-size=<n>] [--copy]
+
+'''
+
+'''
+Stream the rows of a table (via the "postgres" service in <configfile>) to stdout
+as JSONL, without materializing the table in memory on either end.
+
+--columns limits the export to the given (comma-separated) columns, and
+--where-null keeps only rows where each of the given columns IS NULL; for example,
+to export the filenames of our live file assets:
+
+    pgexport.py --config config/ingest_file_assets.yaml --table file_assets --columns=filename --where-null=deleted_ts
+
+By default rows are read through a server-side cursor, --fetch-size rows at a time.
+With --copy, Postgres renders each row as JSON and streams it via COPY ... TO STDOUT.
+'''
+
+import os, sys
+import docopt
+from snap import snap, common
+from mercury.mlog import mlog
+
+
+def main(args):
+
+    sys.path.append(os.getcwd())
+    yaml_config = common.read_config_file(args['<configfile>'])
+    service_registry = common.ServiceObjectRegistry(snap.initialize_services(yaml_config))
+    db_svc = service_registry.lookup('postgres')
+
+    columns = args['--columns'][0].split(',') if args['--columns'] else []
+    where_null = args['--where-null'][0].split(',') if args['--where-null'] else []
+
+    row_count = db_svc.export_jsonl(args['<table_name>'],
+                                    sys.stdout,
+                                    *columns,
+                                    where_null=where_null,
+                                    fetch_size=args['--fetch-size'],
+                                    use_copy=args['--copy'])
+    sys.stdout.flush()
+
+    mlog(f'+++ exported table {args["<table_name>"]}.', rows=row_count)
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
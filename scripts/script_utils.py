@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+'''
+Setup and helpers shared by the scripts in this directory.
+
+Importing this module puts the repository root on sys.path, so that a script can
+import the rq_* modules however it is run (from the repo root, or by its full path
+from anywhere) without PYTHONPATH being set. Scripts import it before any rq_* module.
+'''
+
+import os, sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+import rq_codec as codec
+
+
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/81.0'
+
+
+def read_jsonl(filename):
+    '''Yield the records of a JSONL file, skipping blank lines.'''
+
+    with open(filename, 'r') as f:
+        for raw_line in f:
+            line = raw_line.strip()
+            if not line:
+                continue
+            yield codec.loads(line)
+
+
+def read_manifest(filename):
+    return list(read_jsonl(filename))